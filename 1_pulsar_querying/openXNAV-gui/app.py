@@ -1,5 +1,4 @@
 import re
-import pandas as pd
 import os
 import kivymd.uix
 from kivy.lang import Builder
@@ -11,10 +10,8 @@ from kivy.properties import StringProperty
 from kivy.properties import *
 from kivy.clock import Clock
 from queryPulsar import *
-import copy
-import time
+import threading
 import numpy as np
-from kivymd.uix.label import MDLabel
 
 
 from kivy.core.window import Window
@@ -36,9 +33,12 @@ class StartPage(MDScreen):
 		self.generateLoadingText = lambda txt : "\n\n[b][font=Gentona-BookItalic][size=15sp]{}[/b][/size][/font]".format(txt)
 		self.generateButtonText = lambda txt : "[font=Gentona-Bold]{}[/font]".format(txt)
 
-		self.stack = []
-		self.num_delayed = 0
 		self.db_processing_event = None
+		self.generation_cancel = None
+		self.generation_progress = (0, 0)
+		self.progressBar = None
+		self.loading_text = None
+		self.startButton = None
 
 		Clock.schedule_once(self._on_load_complete)
 
@@ -55,9 +55,33 @@ class StartPage(MDScreen):
 		# initialize
 		updateText(startButton, generateButtonText, "LAUNCH APPLICATION")
 		setEnabled(startButton, False) # disable button until we check for existing db
-		updateText(loading_text, generateLoadingText, "Checking for existing pulsar database . . .")
+		updateText(loading_text, generateLoadingText, "Loading pulsar catalog . . .")
 		progressBar.start()
 
+		# the catalog loads on a background thread (see MainApp.build); show
+		# its progress here and continue once it is ready
+		self.progressBar = progressBar
+		self.loading_text = loading_text
+		self.startButton = startButton
+		_root_app.subscribeDatabaseProgress(self.showDatabaseProgress)
+		_root_app.psrdb_future.add_done_callback(lambda future: Clock.schedule_once(lambda dt: self._on_database_ready(future)))
+
+	def showDatabaseProgress(self, message):
+		updateText(self.loading_text, self.generateLoadingText, message)
+
+	def _on_database_ready(self, future):
+		progressBar = self.progressBar
+		loading_text = self.loading_text
+		startButton = self.startButton
+
+		if future.exception() is not None:
+			progressBar.stop()
+			updateText(loading_text, self.generateLoadingText, "Could not load the pulsar catalog: {}".format(future.exception()))
+			return
+
+		_root_app.psrdb = future.result()
+		updateText(loading_text, self.generateLoadingText, "Checking for existing pulsar database . . .")
+
 		## check for existing database
 		hasExistingDatabase = self.checkForExistingDatabase("pulsar_database/")
 		if hasExistingDatabase: 
@@ -83,52 +107,55 @@ class StartPage(MDScreen):
 		self.generatePulsarDatabase(progressBar, loading_text)
 
 	def checkForExistingDatabase(self, database_directory):
+		# a database is complete once its catalog_version.json has been
+		# written; a directory without it is resumed by generatePulsarDatabase
 		if not os.path.exists(database_directory):
 			os.mkdir(database_directory)
 			return False
 		else: 
-			return True
+			return os.path.exists(database_directory + "catalog_version.json")
 
 	def generatePulsarDatabase(self, progressBar, loading_text, root_directory="pulsar_database/"):
 		# first, grab all known pulsars
 		db = _root_app.psrdb.full_database()
 		progressBar.max = len(db)
 
-		truncated_db = db[['PSRJ','PEPOCH', 'DECJ', 'RAJD']]
-		truncated_db = truncated_db.values.tolist()
+		# write the star files on a background thread in large batches. The
+		# writer threads only store their progress; the UI reads it 10 times a
+		# second, so generation runs at disk speed rather than frame rate.
+		self.generation_cancel = threading.Event()
+		self.generation_progress = (0, len(db))
+		future = run_in_background(write_star_files, db, root_directory, progress=self._on_generation_progress,
+								   cancel=self.generation_cancel, resume=True)
+		self.db_processing_event = Clock.schedule_interval(lambda x: self.updateGenerationProgress(), 0.1)
+		future.add_done_callback(lambda future: Clock.schedule_once(lambda dt: self._on_generation_complete(future, root_directory)))
+
+	def _on_generation_progress(self, done, total):
+		# called from the writer threads
+		self.generation_progress = (done, total)
+
+	def updateGenerationProgress(self):
+		done, total = self.generation_progress
+		self.ids.progress.max = total
+		self.ids.progress.value = done
+		updateText(self.ids.loadingText, self.generateLoadingText, "Writing pulsar database . . . {} / {}".format(done, total))
+
+	def _on_generation_complete(self, future, root_directory):
+		self.db_processing_event.cancel()
+		self.updateGenerationProgress()
+		if future.exception() is not None:
+			updateText(self.ids.loadingText, self.generateLoadingText, "Could not generate pulsar database: {}".format(future.exception()))
+		elif self.generation_cancel.is_set():
+			updateText(self.ids.loadingText, self.generateLoadingText, "Pulsar database generation cancelled. It will resume on the next launch.")
+		else:
+			_root_app.psrdb.write_version(root_directory)
+			updateText(self.ids.loadingText, self.generateLoadingText, "Successfully generated pulsar database!")
+			setEnabled(self.ids.startButton, True)
+
+	def cancelGeneration(self):
+		if self.generation_cancel is not None:
+			self.generation_cancel.set()
 
-		self.db_processing_event = Clock.schedule_interval(lambda x: self.handleSinglePulsarEntry(), 0.001)
-
-		for i in range(0, len(truncated_db)):
-			pulsar = truncated_db[i]
-			p = Pulsar(pulsar[0], pulsar[1], pulsar[2], pulsar[3])
-			self.stack.append(copy.deepcopy(p))
-
-
-	def handleSinglePulsarEntry(self):
-		start = time.perf_counter()
-		progressBar = self.ids.progress
-		loading_text = self.ids.loadingText
-		startButton = self.ids.startButton
-		root_directory = "pulsar_database/"
-
-		if len(self.stack) > 0:
-			pulsar = self.stack.pop()
-			pulsar.saveToFile(root_directory)
-			updateText(loading_text, self.generateLoadingText, "Loading {} into database . . .".format(pulsar.p_name))
-			progressBar.value = progressBar.value + 1
-		else: 
-			self.db_processing_event.cancel()
-			updateText(loading_text, self.generateLoadingText, "Successfully generated pulsar database!")
-			setEnabled(startButton, True) 
-
-		stop = time.perf_counter()
-		if stop - start > 0.5:
-			self.num_delayed = self.num_delayed + 1
-
-
-
-			
 
 class QueryPage(MDScreen):
 	def __init__(self, **kwargs):
@@ -173,20 +200,13 @@ class QueryPage(MDScreen):
 		self.tag1 = user_input
 
 	def updateOutputDisplay(self, display, stack):
-		display.clear_widgets()
-		for i in range(0, len(stack)):
-			display.add_widget(stack[i])
-		stack = []
+		# display is a RecycleView, so only the visible rows have widgets and
+		# long result lists render as quickly as short ones
+		display.data = stack
 
 	def findPulsars(self):
 		print("Your query: " + str(self.raj1) + str(self.dec1) + str(self.rad1))
 		if len(str(self.raj1)) > 0 and  len(str(self.dec1)) > 0 and  len(str(self.rad1)) > 0:
-			result = _root_app.psrdb.query(self.raj1, self.dec1, self.rad1)
-			# result = _root_app.psrdb.query("17:47:26", "65.64", 15)
-
-			truncated_db = result[['PSRJ','PEPOCH', 'DECJ', 'RAJD']]
-			truncated_db = truncated_db.values.tolist()
-
 			data_directory = "query_results/"
 			if not os.path.exists(data_directory):
 				os.mkdir(data_directory)
@@ -205,22 +225,51 @@ class QueryPage(MDScreen):
 			if not os.path.exists(data_directory):
 					os.mkdir(data_directory)
 
-			if len(truncated_db) > 0:
-				banner_str = "[b]{} pulsars found.[/b]".format(str(len(truncated_db))) + "\nResults saved to: " + data_directory
-				self.outputBanner.text = self.generateOutputText(banner_str)
-				
-				for pulsar in truncated_db:
-					p = Pulsar(pulsar[0], pulsar[1], pulsar[2], pulsar[3])
-					nameLabel = "id-" + str(pulsar[0])
-					output_str = self.generateOutputText(str(pulsar[0]))
-					output_widget = MDLabel(id=nameLabel, adaptive_height=True, markup=True, text=output_str, theme_text_color='Secondary', size_hint=[1.0, 0.1])
-					self.outputStack.append(output_widget)
-					p.saveToFile(data_directory)
-			else: 
-				self.outputBanner.text = self.generateOutputText("No pulsars found from this query. Adjust the parameters and try again.".format(str(len(truncated_db)))) 
-
+			# run the query and write the star files off the UI thread; one
+			# query at a time
+			setEnabled(self.ids.find_pulsars_button, False)
+			self.outputBanner.text = self.generateOutputText("Searching . . .")
+			self.outputStack = []
 			self.updateOutputDisplay(self.outputDisplay, self.outputStack)
-			print("Results saved to: " + data_directory)
+
+			future = run_in_background(self._runQuery, self.raj1, self.dec1, self.rad1, data_directory)
+			future.add_done_callback(lambda future: Clock.schedule_once(lambda dt: self._on_query_complete(future, data_directory)))
+
+	def _runQuery(self, raj, dec, rad, data_directory):
+		# background thread: list the results as soon as the query returns,
+		# then save them while the list is already on screen
+		result = _root_app.psrdb.query(raj, dec, rad)
+		names = [str(name) for name in result['PSRJ']]
+		Clock.schedule_once(lambda dt: self.showResults(names, data_directory))
+
+		if len(names) > 0:
+			_root_app.psrdb.write_version(data_directory)
+			write_star_files(result, data_directory, progress=lambda done, total: Clock.schedule_once(lambda dt: self.showSaveProgress(done, total, data_directory)))
+		return len(names)
+
+	def showResults(self, names, data_directory):
+		self.outputStack = [{'text': self.generateOutputText(name), 'markup': True, 'theme_text_color': 'Secondary'} for name in names]
+		self.updateOutputDisplay(self.outputDisplay, self.outputStack)
+		if len(names) > 0:
+			self.showSaveProgress(0, len(names), data_directory)
+
+	def showSaveProgress(self, done, total, data_directory):
+		banner_str = "[b]{} pulsars found.[/b]".format(str(total)) + "\nSaving results to: " + data_directory + " ({} / {})".format(done, total)
+		self.outputBanner.text = self.generateOutputText(banner_str)
+
+	def _on_query_complete(self, future, data_directory):
+		setEnabled(self.ids.find_pulsars_button, True)
+		if future.exception() is not None:
+			self.outputBanner.text = self.generateOutputText("Query failed: {}".format(future.exception()))
+			return
+
+		num_found = future.result()
+		if num_found > 0:
+			banner_str = "[b]{} pulsars found.[/b]".format(str(num_found)) + "\nResults saved to: " + data_directory
+			self.outputBanner.text = self.generateOutputText(banner_str)
+		else: 
+			self.outputBanner.text = self.generateOutputText("No pulsars found from this query. Adjust the parameters and try again.")
+		print("Results saved to: " + data_directory)
 
 
 class ScreenManager(ScreenManager):
@@ -237,7 +286,12 @@ class MainApp(MDApp):
 		global _root_app
 		_root_app = self
 
-		self.psrdb = PulsarDatabase()
+		# load the catalog without blocking the first frame; psrdb is set by
+		# StartPage once psrdb_future is done
+		self.psrdb = None
+		self.psrdb_status = None
+		self.psrdb_listeners = []
+		self.psrdb_future = load_database(progress=self._on_database_progress)
 		self.pulsar_dict = {}
 
 		## theme ##
@@ -253,4 +307,20 @@ class MainApp(MDApp):
 
 		return self.sm
 
-	
\ No newline at end of file
+	def on_stop(self):
+		# stop writing the pulsar database; it resumes on the next launch
+		self.sm.get_screen("startPage").cancelGeneration()
+
+	def _on_database_progress(self, message):
+		# called on the loading thread; forward to the UI thread
+		Clock.schedule_once(lambda dt: self._post_database_progress(message))
+
+	def _post_database_progress(self, message):
+		self.psrdb_status = message
+		for listener in self.psrdb_listeners:
+			listener(message)
+
+	def subscribeDatabaseProgress(self, listener):
+		self.psrdb_listeners.append(listener)
+		if self.psrdb_status is not None:
+			listener(self.psrdb_status)
@@ -0,0 +1,82 @@
+import argparse
+import csv
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from queryPulsar import PulsarDatabase, write_star_files
+
+
+# Headless batch version of the query page: runs every target in a target
+# list file and writes the same query_results/<tag>/ trees as the GUI,
+# without importing Kivy. Each line of the target file is
+#
+#     right ascension, declination, radius[, tag]
+#
+# with the same formats as the GUI fields. Blank lines and lines starting
+# with '#' are ignored. Targets without a tag get the GUI's auto-generated
+# tag.
+
+def readTargets(filename):
+	targets = []
+	with open(filename, newline='') as f:
+		reader = csv.reader(f)
+		for row in reader:
+			row = [field.strip() for field in row]
+			if len(row) == 0 or row[0] == "" or row[0].startswith('#'):
+				continue
+			# bad lines are reported and skipped, so one typo does not abort the batch
+			if len(row) < 3:
+				print("Skipping target line {} with fewer than 3 fields: {}".format(reader.line_num, ", ".join(row)))
+				continue
+			try:
+				rad = float(row[2])
+			except ValueError:
+				print("Skipping target line {} with a non-numeric radius: {}".format(reader.line_num, ", ".join(row)))
+				continue
+			raj, dec = row[0], row[1]
+			if len(row) > 3 and len(row[3]) > 0:
+				tag = row[3]
+			else:
+				tag = re.sub(r'[^a-zA-Z0-9]', '', str(raj) + str(dec) + str(rad))
+			targets.append((raj, dec, rad, tag))
+	return targets
+
+def saveResult(psrdb, result, data_directory):
+	os.makedirs(data_directory, exist_ok=True)
+	if len(result) > 0:
+		psrdb.write_version(data_directory)
+		write_star_files(result, data_directory, max_workers=1)
+	return len(result)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Run OpenXNAV pulsar cone searches from a target list and export STK .st files.")
+	parser.add_argument("targets", help="target list file, one 'RA, DEC, radius[, tag]' per line")
+	parser.add_argument("--output", default="query_results/", help="directory for the per-tag result directories")
+	parser.add_argument("--snapshot", default="catalog_snapshot/", help="catalog snapshot directory")
+	parser.add_argument("--refresh", action="store_true", help="download a new ATNF catalog snapshot first")
+	parser.add_argument("--workers", type=int, default=8, help="number of targets written in parallel")
+	args = parser.parse_args(argv)
+
+	start = time.perf_counter()
+	targets = readTargets(args.targets)
+	psrdb = PulsarDatabase(snapshot_directory=args.snapshot, refresh=args.refresh, cache_directory=None)
+	print("Loaded catalog {} ({} pulsars) in {:.2f} s".format(psrdb.version['catalog_version'], len(psrdb.db), time.perf_counter() - start))
+
+	# all cones in one pass over the catalog, then write the targets in parallel
+	results, union = psrdb.query_many([(raj, dec, rad) for raj, dec, rad, tag in targets])
+	with ThreadPoolExecutor(max_workers=args.workers) as pool:
+		counts = list(pool.map(lambda target, result: saveResult(psrdb, result, os.path.join(args.output, target[3]) + "/"),
+							   targets, results))
+
+	for (raj, dec, rad, tag), count in zip(targets, counts):
+		print("{}: {} pulsars found within {} deg of {} {}".format(tag, count, rad, raj, dec))
+	print("{} targets, {} distinct pulsars, results saved to: {} ({:.2f} s)".format(len(targets), len(union), args.output, time.perf_counter() - start))
+	return 0
+
+
+# run
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,22 +1,356 @@
-from psrqpy import QueryATNF
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+# pandas, scipy, astropy and psrqpy are imported where they are first used,
+# so importing this module (and starting the GUI) stays fast. They are then
+# loaded on the catalog loading thread instead of before the first frame.
+
+
+# columns returned by cone searches, as requested from ATNF before cone
+# searches were answered locally
+QUERY_COLUMNS = ['JNAME', 'PSRJ', 'PEPOCH', 'DECJ', 'RAJD']
+
+
+def _unit_vectors(ra, dec):
+	# ra, dec in radians -> (N, 3) unit vectors on the celestial sphere
+	return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+def _parse_ra(x):
+	# sexagesimal strings are hours, as in psrqpy; plain numbers are degrees
+	if isinstance(x, str) and ':' in x:
+		from astropy.coordinates import Angle
+		return Angle(x, unit='hourangle').rad
+	return np.radians(float(x))
+
+def _parse_dec(y):
+	if isinstance(y, str) and ':' in y:
+		from astropy.coordinates import Angle
+		return Angle(y, unit='deg').rad
+	return np.radians(float(y))
+
+
+def _json_value(v):
+	# numpy scalars -> python; anything else json cannot store -> str
+	if isinstance(v, np.generic):
+		return v.item()
+	if v is None or isinstance(v, (str, int, float, bool)):
+		return v
+	return str(v)
+
+def _save_snapshot(db, path):
+	# snapshots are a plain .npz with one array per numeric column, and the
+	# column order, index and non-numeric columns as a JSON string. Nothing
+	# is pickled, so loading a snapshot copied from another machine cannot
+	# run code.
+	import pandas as pd
+	arrays = {}
+	objects = {}
+	dtypes = {}
+	for i, name in enumerate(db.columns):
+		column = db[name]
+		if column.dtype.kind in 'biuf':
+			arrays['c{}'.format(i)] = column.to_numpy()
+		else:
+			objects[str(i)] = [_json_value(v) for v in column]
+			dtypes[str(i)] = str(column.dtype)
+	index = None
+	if not db.index.equals(pd.RangeIndex(len(db))):
+		index = [_json_value(v) for v in db.index]
+	meta = {'columns': [_json_value(name) for name in db.columns],
+			'index': index,
+			'objects': objects,
+			'dtypes': dtypes}
+	arrays['meta'] = np.array(json.dumps(meta))
+	with open(path, 'wb') as f:
+		np.savez(f, **arrays)
+
+def _load_snapshot(path):
+	import pandas as pd
+	with np.load(path, allow_pickle=False) as z:
+		meta = json.loads(str(z['meta']))
+		data = {}
+		for i, name in enumerate(meta['columns']):
+			if str(i) in meta['objects']:
+				data[i] = pd.Series(meta['objects'][str(i)], dtype=object)
+				if meta['dtypes'][str(i)] != 'object':
+					data[i] = data[i].astype(meta['dtypes'][str(i)])
+			else:
+				data[i] = z['c{}'.format(i)]
+	db = pd.DataFrame(data)
+	db.columns = meta['columns']
+	if meta['index'] is not None:
+		db.index = meta['index']
+	return db
 
 
 class PulsarDatabase():
-	def __init__(self, **kwargs):
-		query = QueryATNF()
-		self.db = query.pandas
+	def __init__(self, snapshot_directory="catalog_snapshot/", refresh=False, progress=None,
+				 cache_size=256, cache_directory="query_cache/", disk_cache_size=4096, **kwargs):
+		# the catalog is loaded from the newest local snapshot if there is one,
+		# so startup needs no network access. The ATNF catalog is only
+		# downloaded when no snapshot exists or refresh is True; if that
+		# download fails, the local snapshot is used. progress, if
+		# given, is called with a status message at each loading stage.
+		#
+		# cone search results are cached as catalog rows, in memory for the
+		# cache_size most recently used cones and on disk in cache_directory
+		# (None disables the disk tier) for the disk_cache_size most recently
+		# used cones
+		self.snapshot_directory = snapshot_directory
+		self.version = None
+		self._lock = threading.Lock()
+		self._progress = progress if progress is not None else (lambda message: None)
+
+		self.cache_size = cache_size
+		self.cache_directory = cache_directory
+		self.disk_cache_size = disk_cache_size
+		self._query_cache = OrderedDict()
+		self._cache_lock = threading.Lock()
+
+		if refresh:
+			loaded = self.refresh() or self.load_snapshot()
+		else:
+			loaded = self.load_snapshot() or self.refresh()
+		if not loaded:
+			raise RuntimeError("No catalog snapshot in " + snapshot_directory + " and the ATNF catalog could not be downloaded.")
+
+	def _build_index(self, db):
+		# KD-tree on the unit vectors of every catalog pulsar with a position,
+		# so that cone searches are answered locally from the catalog
+		from scipy.spatial import cKDTree
+		self._progress("Indexing {} pulsars . . .".format(len(db)))
+		ra = np.radians(np.asarray(db['RAJD'], dtype=float))
+		dec = np.radians(np.asarray(db['DECJD'], dtype=float))
+		indexed_rows = np.nonzero(np.isfinite(ra) & np.isfinite(dec))[0]
+		vectors = _unit_vectors(ra, dec)
+		tree = cKDTree(vectors[indexed_rows])
+		query_table = db[[c for c in QUERY_COLUMNS if c in db.columns]]
+		return indexed_rows, tree, query_table, vectors
+
+	def _set_catalog(self, db, version):
+		# swap catalog, index and version in one assignment, so that a query
+		# running during a background refresh sees either the old or the new
+		# catalog and never a mix of both
+		index = self._build_index(db)
+		self._catalog = (db, index, version)
+		self.db = db
+		self.version = version
+
+	def load_snapshot(self):
+		# returns False if there is no snapshot to load
+		manifest = os.path.join(self.snapshot_directory, "current.json")
+		if not os.path.exists(manifest):
+			return False
+		with open(manifest) as f:
+			version = json.load(f)
+		self._progress("Loading catalog snapshot " + version['catalog_version'] + " . . .")
+		db = _load_snapshot(os.path.join(self.snapshot_directory, version['file']))
+		self._set_catalog(db, version)
+		return True
+
+	def refresh(self):
+		# download the ATNF catalog and save it as a new versioned snapshot.
+		# On failure the current catalog is kept and False is returned.
+		self._progress("Downloading ATNF pulsar catalog . . .")
+		try:
+			from psrqpy import QueryATNF
+			query = QueryATNF()
+			db = query.pandas
+			catalog_version = str(getattr(query, 'get_version', 'unknown'))
+		except Exception as e:
+			print("Could not download the ATNF catalog: " + str(e))
+			return False
+
+		with self._lock:
+			retrieved = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+			version = {'catalog_version': catalog_version,
+					   'retrieved': retrieved,
+					   'rows': len(db),
+					   'file': "atnf_" + catalog_version + "_" + retrieved.replace(":", "") + ".npz"}
+
+			# write the snapshot before pointing current.json at it, so an
+			# interrupted refresh never leaves a half-written current snapshot
+			os.makedirs(self.snapshot_directory, exist_ok=True)
+			path = os.path.join(self.snapshot_directory, version['file'])
+			_save_snapshot(db, path + ".tmp")
+			os.replace(path + ".tmp", path)
+			manifest = os.path.join(self.snapshot_directory, "current.json")
+			with open(manifest + ".tmp", 'w') as f:
+				json.dump(version, f, indent=4)
+			os.replace(manifest + ".tmp", manifest)
+
+			self._set_catalog(db, version)
+		return True
+
+	def refresh_in_background(self, callback=None):
+		# refresh on a daemon thread; callback(success) is called when done
+		def run():
+			success = self.refresh()
+			if callback is not None:
+				callback(success)
+		thread = threading.Thread(target=run, daemon=True)
+		thread.start()
+		return thread
+
+	def write_version(self, directory):
+		# record which catalog snapshot produced the files in directory
+		with open(os.path.join(directory, "catalog_version.json"), 'w') as f:
+			json.dump(self.version, f, indent=4)
 
 	def full_database(self):
 		return self.db
 	
-	def query(self, x, y, r):
-		print(x)
-		print(y)
-		print(r)
-		c = [x, y, r]
-		# result = QueryATNF(coord1=x, coord2=y, radius=r)
-		result = QueryATNF(params=['JNAME', 'PSRJ','PEPOCH', 'DECJ', 'RAJD'], circular_boundary=c)
-		return result.pandas
+	def _cone_rows(self, catalog, ra, dec, r):
+		# catalog rows within r of (ra, dec), all in radians. In order, cones
+		# are answered from the in-memory LRU cache, by filtering the rows of
+		# a cached cone that contains this one, from the disk cache, and
+		# finally from the spatial index. Keys are normalized to 1e-9 degrees
+		# and include the catalog snapshot, so a refresh invalidates them.
+		db, (indexed_rows, tree, query_table, vectors), version = catalog
+		snapshot = version['file'] if version is not None else None
+		key = (snapshot,) + tuple(round(float(np.degrees(a)), 9) for a in (ra, dec, r))
+		centre = _unit_vectors(ra, dec)
+
+		with self._cache_lock:
+			if key in self._query_cache:
+				self._query_cache.move_to_end(key)
+				return self._query_cache[key][2]
+
+			# a cached cone of radius r_c contains this one if the angle
+			# between the centres plus r is at most r_c
+			for c_key, (c_centre, c_r, c_rows) in self._query_cache.items():
+				if c_key[0] == snapshot and c_r >= r:
+					angle = np.arccos(np.clip(np.dot(centre, c_centre), -1, 1))
+					if angle + r <= c_r:
+						rows = c_rows[vectors[c_rows] @ centre >= np.cos(r)]
+						self._cache_rows(key, centre, r, rows)
+						return rows
+
+		path = None
+		if self.cache_directory is not None:
+			path = os.path.join(self.cache_directory, hashlib.sha1(repr(key).encode()).hexdigest() + ".npy")
+		if path is not None and os.path.exists(path):
+			rows = np.load(path)
+			# the modification time orders the disk tier by last use
+			os.utime(path)
+		else:
+			# angular radius r corresponds to a chord of 2 sin(r / 2) between
+			# unit vectors
+			rows = tree.query_ball_point(centre, 2 * np.sin(r / 2))
+			rows = indexed_rows[np.sort(np.asarray(rows, dtype=int))]
+			if path is not None:
+				os.makedirs(self.cache_directory, exist_ok=True)
+				with open(path + ".tmp", 'wb') as f:
+					np.save(f, rows)
+				os.replace(path + ".tmp", path)
+				self._evict_disk_cache()
+
+		with self._cache_lock:
+			self._cache_rows(key, centre, r, rows)
+		return rows
+
+	def _evict_disk_cache(self):
+		# remove the least recently used cone files beyond disk_cache_size
+		entries = [e for e in os.scandir(self.cache_directory) if e.name.endswith(".npy")]
+		if len(entries) <= self.disk_cache_size:
+			return
+		used = []
+		for entry in entries:
+			try:
+				used.append((entry.stat().st_mtime, entry.path))
+			except OSError:
+				# already removed by another query
+				pass
+		used.sort()
+		for mtime, path in used[:len(used) - self.disk_cache_size]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+	def _cache_rows(self, key, centre, r, rows):
+		# caller holds _cache_lock
+		rows.flags.writeable = False
+		self._query_cache[key] = (centre, r, rows)
+		self._query_cache.move_to_end(key)
+		while len(self._query_cache) > self.cache_size:
+			self._query_cache.popitem(last=False)
+
+	def query(self, x, y, r, params=None):
+		# cone search of radius r (degrees) around RA x, DEC y, answered from
+		# the query cache or the spatial index instead of a new ATNF request.
+		# params selects the returned columns; the default is QUERY_COLUMNS.
+		catalog = self._catalog
+		db, (indexed_rows, tree, query_table, vectors), version = catalog
+		rows = self._cone_rows(catalog, _parse_ra(x), _parse_dec(y), np.radians(min(float(r), 180.0)))
+		if params is None:
+			result = query_table.take(rows).reset_index(drop=True)
+		else:
+			result = db.take(rows)[[c for c in params if c in db.columns]].reset_index(drop=True)
+		result.attrs['catalog_version'] = version
+		return result
+
+	def query_many(self, targets, params=None):
+		# cone searches for many (x, y, r) targets in one vectorized pass over
+		# the catalog, with x, y, r as in query(). Returns the list of
+		# per-target results and their union, which holds every matching
+		# pulsar once in catalog order, plus a TARGETS column listing the
+		# indices of the targets it matched.
+		catalog = self._catalog
+		db, (indexed_rows, tree, query_table, vectors), version = catalog
+		targets = list(targets)
+		centres = np.array([_unit_vectors(_parse_ra(x), _parse_dec(y)) for x, y, r in targets]).reshape(-1, 3)
+		radii = np.radians(np.minimum([float(r) for x, y, r in targets], 180.0))
+
+		# (pulsars, targets) membership matrix
+		inside = vectors[indexed_rows] @ centres.T >= np.cos(radii)
+
+		if params is None:
+			table = query_table
+		else:
+			table = db[[c for c in params if c in db.columns]]
+
+		results = []
+		for t in range(len(targets)):
+			result = table.take(indexed_rows[inside[:, t]]).reset_index(drop=True)
+			result.attrs['catalog_version'] = version
+			results.append(result)
+
+		matched = np.nonzero(inside.any(axis=1))[0]
+		union = table.take(indexed_rows[matched]).reset_index(drop=True)
+		union['TARGETS'] = [list(np.nonzero(row)[0]) for row in inside[matched]]
+		union.attrs['catalog_version'] = version
+		return results, union
+
+
+def run_in_background(fn, *args, **kwargs):
+	# call fn(*args, **kwargs) on a background thread and return a
+	# concurrent.futures.Future that resolves to its result (or to the
+	# exception it raised). The thread is a daemon so that closing the app
+	# during a catalog download or database generation does not hang on exit.
+	future = Future()
+
+	def run():
+		if not future.set_running_or_notify_cancel():
+			return
+		try:
+			future.set_result(fn(*args, **kwargs))
+		except Exception as e:
+			future.set_exception(e)
+
+	threading.Thread(target=run, daemon=True).start()
+	return future
+
+def load_database(**kwargs):
+	# construct a PulsarDatabase in the background; see run_in_background
+	return run_in_background(PulsarDatabase, **kwargs)
 
 
 def formatPulsarName(p_name):
@@ -29,6 +363,94 @@ def formatPulsarName(p_name):
 		p_name = name_split[0] + "_" + name_split[1]
 	return p_name
 
+# STK star file template, filled in by Pulsar.render and write_star_files
+_ST_TEMPLATE = (
+	'stk.v.12.0\n'
+	'WrittenBy    OpenXNAV\n'
+	'\n'
+	'BEGIN Star\n'
+	'\n'
+	'    Name\t\t {p_name}\n'
+	'\n'
+	'    BEGIN PathDescription\n'
+	'\n'
+	'        Epoch\t\t  {epoch}\n'
+	'        RefFrame\t\t {ref_frame}\n'
+	'        RightAscension\t\t  {right_a}\n'
+	'        Declination\t\t  {dec}\n'
+	'        ProperMotionRAPerYr\t\t {ra_per_yr}\n'
+	'        ProperMotionDecPerYr\t\t {dec_per_yr}\n'
+	'        Parallax\t\t  {parallax}\n'
+	'        RadialVelocity\t\t  {rv}\n'
+	'\n'
+	'    END PathDescription\n'
+	'\n'
+	'    BEGIN PhysicalData\n'
+	'\n'
+	'        Magnitude\t\t  {magnitude}\n'
+	'\n'
+	'    END PhysicalData\n'
+	'\n'
+	'    BEGIN IdentityData\n'
+	'\n'
+	'        Id\t\t {p_id}\n'
+	'\n'
+	'    END IdentityData\n'
+	'\n'
+	'\n'
+	'    BEGIN Extensions\n'
+	'\n'
+	'        BEGIN ExternData\n'
+	'        END ExternData\n'
+	'\n'
+	'        BEGIN ADFFileData\n'
+	'        END ADFFileData\n'
+	'\n'
+	'        BEGIN AccessConstraints\n'
+	'            LineOfSight IncludeIntervals\n'
+	'\n'
+	'            UsePreferredMaxStep No\n'
+	'            PreferredMaxStep 360\n'
+	'        END AccessConstraints\n'
+	'\n'
+	'        BEGIN Desc\n'
+	'        END Desc\n'
+	'\n'
+	'        BEGIN Crdn\n'
+	'        END Crdn\n'
+	'\n'
+	'        BEGIN Graphics\n'
+	'\n'
+	'            BEGIN Attributes\n'
+	'\n'
+	'                MarkerColor\t\t #00ff00\n'
+	'                LabelColor\t\t #00ff00\n'
+	'                MarkerStyle\t\t 2\n'
+	'                FontStyle\t\t 0\n'
+	'\n'
+	'            END Attributes\n'
+	'\n'
+	'            BEGIN Graphics\n'
+	'\n'
+	'                Show\t\t On\n'
+	'                Inherit\t\t On\n'
+	'                ShowLabel\t\t On\n'
+	'                ShowMarker\t\t On\n'
+	'\n'
+	'            END Graphics\n'
+	'        END Graphics\n'
+	'\n'
+	'        BEGIN VO\n'
+	'        END VO\n'
+	'\n'
+	'    END Extensions\n'
+	'\n'
+	'END Star'
+)
+
+# write buffer per star file; one buffer holds a whole .st file
+STAR_FILE_BUFFER = 1 << 13
+
 class Pulsar(): 
 	def __init__(self, p_name, epoch, dec, right_a, ref_frame='J2000'):
 		self.p_name = p_name
@@ -48,88 +470,98 @@ class Pulsar():
 		# parse name
 		self.p_name = formatPulsarName(self.p_name)
 
-
-		# generate lines for file
-		##
-		lines = ['stk.v.12.0\n', 'WrittenBy    OpenXNAV\n\n', 'BEGIN Star\n\n']
-		lines.append('    Name		 ' + self.p_name + '\n\n')
-		lines.append('    BEGIN PathDescription\n\n')
-
-		lines.append('        Epoch		  ' + str(self.epoch) + '\n')
-
-		lines.append('        RefFrame		 ' + str(self.ref_frame) + '\n')
-
-		lines.append('        RightAscension		  ' + str(self.right_a) + '\n')
-
-		lines.append('        Declination		  ' + str(self.dec) + '\n')
-
-		# PMElong ?
-		lines.append('        ProperMotionRAPerYr		 ' + str(self.ra_per_yr) + '\n')
-
-		# PMElat ?
-		lines.append('        ProperMotionDecPerYr		 ' + str(self.dec_per_yr) + '\n')
-
-		lines.append('        Parallax		  ' + str(self.parallax) + '\n')
-
-		# VTrans ? 
-		lines.append('        RadialVelocity		  ' + str(self.rv) + '\n\n')
-
-		lines.append('    END PathDescription\n\n')
-		lines.append('    BEGIN PhysicalData\n\n')
-
-		lines.append('        Magnitude		  ' + str(self.magnitude) + "\n\n")
-
-		lines.append('    END PhysicalData\n\n')
-		lines.append('    BEGIN IdentityData\n\n')
-
-		lines.append('        Id		 ' + str(self.p_id) + "\n\n")
-
-		lines.append('    END IdentityData\n\n\n')
-
-		lines.append('    BEGIN Extensions\n\n')
-
-		lines.append('        BEGIN ExternData\n')
-		lines.append('        END ExternData\n\n')
-
-		lines.append('        BEGIN ADFFileData\n')
-		lines.append('        END ADFFileData\n\n')
-
-		lines.append('        BEGIN AccessConstraints\n')
-		lines.append('            LineOfSight IncludeIntervals\n\n')
-		lines.append('            UsePreferredMaxStep No\n')
-		lines.append('            PreferredMaxStep 360\n')
-		lines.append('        END AccessConstraints\n\n')
-
-		lines.append('        BEGIN Desc\n')
-		lines.append('        END Desc\n\n')
-
-		lines.append('        BEGIN Crdn\n')
-		lines.append('        END Crdn\n\n')
-
-		lines.append('        BEGIN Graphics\n\n')
-
-		lines.append('            BEGIN Attributes\n\n')
-		lines.append('                MarkerColor		 #00ff00\n')
-		lines.append('                LabelColor		 #00ff00\n')
-		lines.append('                MarkerStyle		 2\n')
-		lines.append('                FontStyle		 0\n\n')
-		lines.append('            END Attributes\n\n')
-
-		lines.append('            BEGIN Graphics\n\n')
-		lines.append('                Show		 On\n')
-		lines.append('                Inherit		 On\n')
-		lines.append('                ShowLabel		 On\n')
-		lines.append('                ShowMarker		 On\n\n')
-		lines.append('            END Graphics\n')
-		lines.append('        END Graphics\n\n')
-
-		lines.append('        BEGIN VO\n')
-		lines.append('        END VO\n\n')
-		lines.append('    END Extensions\n\n')
-		lines.append('END Star')
-
 		filename = root_directory + self.p_name + ".st"
 		with open(filename, 'w') as f:
-			for line in lines:
-				f.write(line)
-		f.close()
+			f.write(self.render())
+
+	def render(self):
+		# contents of the STK .st star file for this pulsar
+		return _ST_TEMPLATE.format(p_name=self.p_name, epoch=self.epoch, dec=self.dec, right_a=self.right_a,
+								   ref_frame=self.ref_frame, ra_per_yr=self.ra_per_yr, dec_per_yr=self.dec_per_yr,
+								   parallax=self.parallax, rv=self.rv, magnitude=self.magnitude, p_id=self.p_id)
+
+
+def _compiled_star_template():
+	# _ST_TEMPLATE with the fields that are the same for every catalog pulsar
+	# filled in from the Pulsar defaults, leaving only positional fields
+	# {0} name, {1} epoch, {2} dec and {3} right ascension
+	defaults = Pulsar('', '', '', '')
+	return _ST_TEMPLATE.format(p_name='{0}', epoch='{1}', dec='{2}', right_a='{3}',
+							   ref_frame=defaults.ref_frame, ra_per_yr=defaults.ra_per_yr, dec_per_yr=defaults.dec_per_yr,
+							   parallax=defaults.parallax, rv=defaults.rv, magnitude=defaults.magnitude, p_id=defaults.p_id)
+
+def _write_star_chunk(root_directory, items):
+	for p_name, text in items:
+		with open(root_directory + p_name + ".st", 'w', buffering=STAR_FILE_BUFFER) as f:
+			f.write(text)
+	return len(items)
+
+def _star_file_complete(root_directory, p_name, text, existing):
+	# a star file left by an earlier, interrupted run is kept if it has the
+	# size its text has once written in text mode
+	if p_name + ".st" not in existing:
+		return False
+	size = len(text.encode()) + text.count('\n') * (len(os.linesep) - 1)
+	return os.path.getsize(root_directory + p_name + ".st") == size
+
+def write_star_files(db, root_directory, max_workers=4, chunk_size=256, archive=None,
+					 progress=None, cancel=None, resume=False):
+	# bulk replacement for Pulsar(...).saveToFile(root_directory) over every
+	# row of a catalog DataFrame with columns PSRJ, PEPOCH, DECJ and RAJD.
+	# Each record is rendered from a precompiled template and files are
+	# written in chunks by a pool of max_workers threads, one buffered write
+	# per file. The .st contents are byte-identical to saveToFile; when two
+	# pulsars format to the same file name, the later row wins, as it would
+	# when saving in order.
+	#
+	# If archive is given, the files are instead stored as members of a
+	# single zip file root_directory + archive, whose central directory
+	# indexes them by file name.
+	#
+	# progress(done, total) is called from the writer threads after every
+	# chunk. Setting the threading.Event cancel stops writing after the
+	# chunks in progress. With resume, complete star files already in
+	# root_directory are not written again; they count as done.
+	# Returns the number of star files written.
+	template = _compiled_star_template()
+	records = db[['PSRJ', 'PEPOCH', 'DECJ', 'RAJD']].values.tolist()
+
+	files = {}
+	for p_name, epoch, dec, right_a in records:
+		p_name = formatPulsarName(p_name)
+		files[p_name] = template.format(p_name, epoch, dec, right_a)
+
+	if archive is not None:
+		import zipfile
+		with zipfile.ZipFile(root_directory + archive, 'w', zipfile.ZIP_DEFLATED) as z:
+			for p_name, text in files.items():
+				if cancel is not None and cancel.is_set():
+					break
+				z.writestr(p_name + ".st", text)
+		return len(z.namelist())
+
+	total = len(files)
+	if resume:
+		existing = set(os.listdir(root_directory))
+		files = {p_name: text for p_name, text in files.items()
+				 if not _star_file_complete(root_directory, p_name, text, existing)}
+
+	items = list(files.items())
+	chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+	done = [total - len(items)]
+	lock = threading.Lock()
+
+	def write_chunk(chunk):
+		if cancel is not None and cancel.is_set():
+			return 0
+		written = _write_star_chunk(root_directory, chunk)
+		with lock:
+			done[0] += written
+			if progress is not None:
+				progress(done[0], total)
+		return written
+
+	if progress is not None:
+		progress(done[0], total)
+	with ThreadPoolExecutor(max_workers=max_workers) as pool:
+		return sum(pool.map(write_chunk, chunks))
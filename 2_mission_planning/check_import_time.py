@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Import-time check for mission_planning.
+
+Imports the module in fresh interpreters and fails if it takes longer than
+the budget, if it pulls in pandas, matplotlib or sympy, or if it registers
+astropy's Time converter with matplotlib's units registry (as time_support()
+did). Run from any directory:
+
+    python check_import_time.py [--budget SECONDS] [--runs N]
+
+Exits with status 1 if any check fails.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Runs in the child interpreter: time the import, list the heavy modules it
+# loaded, then look at matplotlib's units registry (importing matplotlib only
+# after the timing and module checks).
+CHILD = '''
+import json, sys, time
+t0 = time.perf_counter()
+import mission_planning
+seconds = time.perf_counter() - t0
+loaded = sorted(name for name in ('pandas', 'matplotlib', 'sympy')
+                if name in sys.modules)
+import matplotlib.units
+from astropy.time import Time
+print(json.dumps({'seconds': seconds, 'loaded': loaded,
+                  'time_converter': Time in matplotlib.units.registry}))
+'''
+
+def measure():
+    '''
+    Imports mission_planning in a new interpreter.
+
+    Returns
+    -------
+    dict
+        Import time in seconds, heavy modules loaded by the import, and
+        whether the matplotlib registry holds a Time converter afterwards.
+
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable,'-c',CHILD],cwd=here,
+                         capture_output=True,text=True,check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that importing '
+                                     'mission_planning stays fast and free '
+                                     'of heavy side effects.')
+    parser.add_argument('--budget',type=float,default=2.0,
+                        help='maximum import time in seconds (default 2.0)')
+    parser.add_argument('--runs',type=int,default=3,
+                        help='imports to time; the fastest counts (default 3)')
+    args = parser.parse_args(argv)
+
+    # the first run also warms the bytecode and disk caches
+    results = [measure() for i in range(max(1,args.runs))]
+    seconds = min(result['seconds'] for result in results)
+    loaded = sorted(set(name for result in results for name in result['loaded']))
+    time_converter = any(result['time_converter'] for result in results)
+
+    failures = []
+    if seconds > args.budget:
+        failures.append('import took {:.3f} s, over the {:.3f} s budget'
+                        .format(seconds,args.budget))
+    if loaded:
+        failures.append('import loaded ' + ', '.join(loaded))
+    if time_converter:
+        failures.append('import registered a Time converter with matplotlib')
+
+    print('import mission_planning: {:.3f} s (budget {:.3f} s)'
+          .format(seconds,args.budget))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if not failures:
+        print('OK')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,20 +5,20 @@ Created on Thu Aug  3 15:48:44 2023
 @author: berksma1
 """
 
+import hashlib
+import json
+import os
+import warnings
+
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 
 from astropy import units as u
-from astropy.coordinates import SkyCoord
-from astropy.table import QTable
-
-from sympy.solvers import nsolve
-from sympy import Symbol
-from sympy import sin
+from astropy.coordinates import SkyCoord, CartesianRepresentation, get_body
 
-from astropy.visualization import time_support
-time_support()
+# pandas, matplotlib, astropy.table and the multiprocessing machinery are
+# imported where they are used, so that importing this module for the orbit
+# and access math (e.g. in worker processes) stays fast and leaves global
+# matplotlib state alone.
 
 # Definitions of universal constants
 G = 6.67259e-11* u.N*u.m**2/(u.kg**2)  # G is the universal gravitation constant in Nm^2/kg^2
@@ -28,8 +28,8 @@ M_Earth = 5.97219e24*u.kg              # kg mass of body being orbitted, for thi
 
 def _get_xyz(sc):
     '''
-    Returns a 3 x len(sc) Quantity array of x,y,z coordinates of a given
-    SkyCoord object.
+    Returns a len(sc) x 3 Quantity array of x,y,z coordinates of a given
+    SkyCoord object, without changing its representation_type.
 
     Parameters
     ----------
@@ -38,12 +38,36 @@ def _get_xyz(sc):
     Returns
     -------
     astropy.units.Quantity
-        DESCRIPTION.
+        Cartesian coordinates of sc.
+
+    '''
+    return sc.cartesian.xyz.T
+
+def _xyz_m(sc):
+    '''
+    Returns x,y,z coordinates of a given SkyCoord object as a plain float
+    array in meters, of shape (3,) or (N,3). Trajectories hand out their
+    array core directly.
+    '''
+    state = getattr(sc,'_state',None)
+    if state is not None:
+        return state.pos
+    return np.moveaxis(sc.cartesian.xyz.to_value(u.m),0,-1)
+
+def _stack_xyz(x,y,z,unit):
+    '''
+    Stacks x,y,z Quantities (or scalars, which are broadcast) into a
+    contiguous (N,3) float64 array in the given unit.
+    '''
+    xyz = np.broadcast_arrays(*[u.Quantity(c).to_value(unit) for c in (x,y,z)])
+    return np.ascontiguousarray(np.stack(xyz,axis=-1),dtype=np.float64).reshape(-1,3)
 
+def _rad(angle):
+    '''
+    Returns an angle Quantity as a plain float in radians. Plain numbers are
+    taken to be in radians already.
     '''
-    sc_xyz = sc
-    sc_xyz.representation_type = 'cartesian'
-    return u.Quantity([sc_xyz.x,sc_xyz.y,sc_xyz.z]).T
+    return u.Quantity(angle,u.rad).to_value(u.rad)
 
 def _rotate(vec,Omega,inc,w):
     '''
@@ -55,12 +79,12 @@ def _rotate(vec,Omega,inc,w):
     ----------
     vec : array-like
         Array of coordinates to be rotated.
-    Omega : Quantity (angle)
-        Longitude of ascending node.
-    inc : Quantity (angle)
-        Inclination of orbit.
-    w : Quantity (angle)
-        Argument of periapsis.
+    Omega : float
+        Longitude of ascending node in radians.
+    inc : float
+        Inclination of orbit in radians.
+    w : float
+        Argument of periapsis in radians.
 
     Returns
     -------
@@ -82,6 +106,331 @@ def _rotate(vec,Omega,inc,w):
     
     return vec.dot(long_asc_node).dot(incline).dot(periapsis)
 
+def _solve_kepler(M,e,tol=1e-12,max_iter=50):
+    '''
+    Solves Kepler's equation M = E - e*sin(E) for the eccentric anomaly at
+    every mean anomaly at once, using Halley's method from Danby's starting
+    guess. Converges for all 0 <= e < 1.
+
+    Parameters
+    ----------
+    M : array_like
+        Mean anomaly in radians.
+    e : float
+        Eccentricity of orbit.
+    tol : float, optional
+        Convergence tolerance on |E - e*sin(E) - M| in radians. The default
+        is 1e-12.
+    max_iter : int, optional
+        Maximum number of Halley iterations. The default is 50.
+
+    Returns
+    -------
+    E : numpy.array
+        Eccentric anomaly in radians, continuous with M.
+    n_failed : int
+        Number of elements that did not converge within max_iter iterations.
+
+    '''
+    M = np.asarray(M,dtype=float)
+
+    # solve on [-pi, pi) and add the whole revolutions back afterwards
+    M_wrap = np.remainder(M + np.pi, 2*np.pi) - np.pi
+    E = M_wrap + 0.85 * e * np.sign(np.sin(M_wrap))
+
+    for i in range(max_iter+1):
+        sin_E = np.sin(E)
+        f = E - e*sin_E - M_wrap
+        converged = np.abs(f) <= tol
+        if converged.all() or i == max_iter:
+            break
+
+        f1 = 1 - e*np.cos(E)
+        f2 = e*sin_E
+        delta = f/f1
+        E = E - f/(f1 - 0.5*delta*f2)
+
+    return E + (M - M_wrap), int(np.count_nonzero(~converged))
+
+def _parse_bodies(args):
+    '''
+    Splits the alternating (body, radius) *args accepted by the access methods
+    into a list of body positions and a list of radii.
+
+    Parameters
+    ----------
+    args : tuple
+        Celestial bodies and their respective radii. Elements of args should
+        alternate in type between astropy.coordinates.SkyCoord and Quantity
+        (distance).
+
+    Returns
+    -------
+    objects_xyz : list of numpy.array
+        Cartesian position of each body in meters, shape (3,) for a fixed body
+        or (T,3) for a body with one position per obstime.
+    radii : list of float
+        Radius of each body in meters.
+
+    '''
+    objects_xyz = [_xyz_m(obj) for obj in args[::2]]
+    radii = [u.Quantity(radius).to_value(u.m) for radius in args[1::2]]
+    return objects_xyz, radii
+
+def _access_margin(sc_xyz,p_xyz,o_xyz,object_rad):
+    '''
+    Calculates the angular margin ang_BP - ang_S between the line of sight to
+    a pulsar and the limb of an occulting body. The pulsar is visible wherever
+    the margin is positive.
+
+    All inputs are plain float arrays in meters, with x,y,z along the last
+    axis, and are broadcast against each other.
+
+    Parameters
+    ----------
+    sc_xyz : numpy.array
+        Spacecraft positions, shape (T,3).
+    p_xyz : numpy.array
+        Pulsar positions, shape (3,), (T,3) or (P,T,3).
+    o_xyz : numpy.array
+        Occulting body positions, shape (3,) or (T,3).
+    object_rad : float
+        Radius of the occulting body.
+
+    Returns
+    -------
+    numpy.array
+        Margin in radians, shape of the broadcast leading axes.
+
+    '''
+    s2o_vec = o_xyz - sc_xyz
+    s2p_vec = p_xyz - sc_xyz
+
+    # sin(ang_s) = object_rad / s2o
+    s2o_norm = np.linalg.norm(s2o_vec,axis=-1)
+    ang_S = np.arcsin(object_rad / s2o_norm)
+
+    # tan(ang_BP) = ||s2p_vec x s2o_vec|| / (s2p dot s2o)
+    cross = np.linalg.norm(np.cross(s2o_vec,s2p_vec),axis=-1)
+    dot = np.einsum('...i,...i->...',s2p_vec,s2o_vec)
+    ang_BP = np.arctan2(cross,dot)
+
+    return ang_BP - ang_S
+
+def _access_matrix(sc_xyz,p_xyz,objects_xyz,radii):
+    '''
+    Vectorized pulsar access engine. Evaluates every pulsar against every
+    occulting body at every obstime in one pass, keeping at most one (P,T)
+    margin array alive per body.
+
+    Parameters
+    ----------
+    sc_xyz : numpy.array
+        Spacecraft positions in meters, shape (T,3).
+    p_xyz : numpy.array
+        Pulsar positions in meters, shape (P,T,3) or (P,1,3).
+    objects_xyz : list of numpy.array
+        Occulting body positions in meters, each of shape (3,) or (T,3).
+    radii : list of float
+        Occulting body radii in meters.
+
+    Returns
+    -------
+    access : numpy.array
+        (P,T) array of bool values, True where the pulsar is not obstructed
+        by any of the bodies.
+
+    '''
+    shape = np.broadcast_shapes(p_xyz.shape[:-1],(1,len(sc_xyz)))
+    access = np.ones(shape,dtype=bool)
+
+    for o_xyz,object_rad in zip(objects_xyz,radii):
+        access &= _access_margin(sc_xyz,p_xyz,o_xyz,object_rad) > 0
+
+    return access
+
+def _limb_margin(s2o_vec,dot,object_rad):
+    '''
+    Angular margin ang_BP - ang_S for pulsars at infinity along unit
+    direction vectors d, given the spacecraft-to-body vectors s2o_vec and the
+    dot products of d with s2o_vec. Shapes broadcast as for _access_margin.
+    '''
+    s2o_sq = np.einsum('...i,...i->...',s2o_vec,s2o_vec)
+
+    # sin(ang_s) = object_rad / s2o
+    ang_S = np.arcsin(object_rad / np.sqrt(s2o_sq))
+
+    # tan(ang_BP) = ||d x s2o_vec|| / (d dot s2o_vec), where for a unit
+    # vector d, ||d x s2o_vec||^2 = s2o^2 - (d dot s2o_vec)^2
+    cross = np.sqrt(np.maximum(s2o_sq - dot**2,0))
+    ang_BP = np.arctan2(cross,dot)
+
+    return ang_BP - ang_S
+
+def _direction_margin(sc_xyz,directions,o_xyz,object_rad):
+    '''
+    Calculates the (P,T) margin ang_BP - ang_S of P pulsars, given as unit
+    direction vectors, against one occulting body at T spacecraft positions.
+    The P x T dot products are a single matrix product.
+
+    Parameters
+    ----------
+    sc_xyz : numpy.array
+        Spacecraft positions in meters, shape (T,3).
+    directions : numpy.array
+        Pulsar unit direction vectors, shape (P,3).
+    o_xyz : numpy.array
+        Occulting body positions in meters, shape (3,) or (T,3).
+    object_rad : float
+        Radius of the occulting body in meters.
+
+    Returns
+    -------
+    numpy.array
+        (P,T) margin in radians.
+
+    '''
+    s2o_vec = np.broadcast_to(o_xyz - sc_xyz,sc_xyz.shape)
+    return _limb_margin(s2o_vec,directions @ s2o_vec.T,object_rad)
+
+def _direction_access_matrix(sc_xyz,directions,objects_xyz,radii):
+    '''
+    Vectorized pulsar access engine for catalog pulsars, which are treated as
+    infinitely distant along their unit direction vectors. Memory use is
+    O(P*T).
+
+    Parameters
+    ----------
+    sc_xyz : numpy.array
+        Spacecraft positions in meters, shape (T,3).
+    directions : numpy.array
+        Pulsar unit direction vectors, shape (P,3).
+    objects_xyz : list of numpy.array
+        Occulting body positions in meters, each of shape (3,) or (T,3).
+    radii : list of float
+        Occulting body radii in meters.
+
+    Returns
+    -------
+    access : numpy.array
+        (P,T) array of bool values, True where the pulsar is not obstructed
+        by any of the bodies.
+
+    '''
+    access = np.ones((len(directions),len(sc_xyz)),dtype=bool)
+
+    for o_xyz,object_rad in zip(objects_xyz,radii):
+        access &= _direction_margin(sc_xyz,directions,o_xyz,object_rad) > 0
+
+    return access
+
+def _share_array(arr):
+    '''
+    Copies an array into a new block of shared memory so that worker
+    processes can attach to it by name instead of receiving a pickled copy.
+
+    Returns
+    -------
+    shm : multiprocessing.shared_memory.SharedMemory
+        Shared memory block. The caller is responsible for closing and
+        unlinking it.
+    spec : tuple
+        (name, shape, dtype) used by _attach_array to rebuild the array.
+
+    '''
+    arr = np.ascontiguousarray(arr)
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+    np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[...] = arr
+    return shm, (shm.name,arr.shape,arr.dtype.str)
+
+def _attach_array(spec):
+    '''
+    Attaches to an array created by _share_array. Returns the shared memory
+    block, which must be kept open while the array is in use, and the array.
+    '''
+    name, shape, dtype = spec
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+
+def _access_worker(specs,start,stop,radii):
+    '''
+    Process pool task for pulsar_access_export. Calculates access for rows
+    start:stop of the pulsar catalog and writes them into the shared access
+    matrix.
+    '''
+    blocks = {key:_attach_array(spec) for key,spec in specs.items()}
+    arrays = {key:arr for key,(shm,arr) in blocks.items()}
+    try:
+        objects_xyz = [arrays['body'+str(i)] for i in range(len(radii))]
+        arrays['access'][start:stop] = _direction_access_matrix(
+            arrays['sc_xyz'],arrays['directions'][start:stop],
+            objects_xyz,radii)
+    finally:
+        for shm,arr in blocks.values():
+            shm.close()
+
+def _lerp(a,b,frac):
+    '''
+    Linear interpolation between a and b, where frac runs from 0 to 1.
+    '''
+    return a + (b - a)*frac
+
+_direction_cache = {}
+
+def catalog_directions(pulsar_qtbl):
+    '''
+    Converts the RAJD/DECJD columns of a whole pulsar catalog into a (P,3)
+    matrix of unit direction vectors, the form in which all catalog access
+    calculations use pulsars.
+
+    Pulsars are far enough away to be treated as infinitely distant, and the
+    axes of the GCRS trajectory frame are parallel to ICRS, so the same
+    matrix serves every trajectory. Annual aberration (at most 20.5 arcsec)
+    is neglected. Matrices are cached by catalog coordinates, so repeated
+    calls for the same catalog return the same read-only array.
+
+    Parameters
+    ----------
+    pulsar_qtbl : astropy.table.QTable
+        QTable of pulsars with columns RAJD and DECJD.
+
+    Returns
+    -------
+    numpy.array
+        (P,3) array of unit direction vectors.
+
+    '''
+    ra = u.Quantity(pulsar_qtbl['RAJD'],u.deg).to_value(u.rad)
+    dec = u.Quantity(pulsar_qtbl['DECJD'],u.deg).to_value(u.rad)
+    key = hashlib.sha1(np.ascontiguousarray(ra).tobytes()
+                       + np.ascontiguousarray(dec).tobytes()).hexdigest()
+
+    if key not in _direction_cache:
+        if len(_direction_cache) >= 16:
+            _direction_cache.pop(next(iter(_direction_cache)))
+        directions = np.stack([np.cos(dec)*np.cos(ra),
+                               np.cos(dec)*np.sin(ra),
+                               np.sin(dec)],axis=-1)
+        directions.flags.writeable = False
+        _direction_cache[key] = directions
+
+    return _direction_cache[key]
+
+def _as_directions(pulsars):
+    '''
+    Returns the (P,3) unit direction matrix of pulsars given as a catalog
+    QTable, a SkyCoord, or an existing direction matrix.
+    '''
+    if isinstance(pulsars,SkyCoord):
+        xyz = pulsars.icrs.represent_as('unitspherical').to_cartesian().xyz
+        return np.moveaxis(u.Quantity(xyz).value,0,-1)
+    from astropy.table import Table
+    if isinstance(pulsars,Table):
+        return catalog_directions(pulsars)
+    return np.asarray(pulsars,dtype=float)
+
 def plot_accesses(ax,t,accesses):
     '''
     Creates a plot of pulsar access vs. time
@@ -108,12 +457,11 @@ def plot_accesses(ax,t,accesses):
     
     for i, (pulsar, access_array) in enumerate(accesses.items()):
 
-        access_df = pd.DataFrame(access_array,columns=['access'])
-        has_access = access_df[access_df['access'] == True]
+        has_access = np.flatnonzero(access_array)
 
         for j in range(len(has_access)-1):
-            xmin_j = t.datetime64[has_access.index[j]]
-            xmax_j = t.datetime64[has_access.index[j]+1]
+            xmin_j = t.datetime64[has_access[j]]
+            xmax_j = t.datetime64[has_access[j]+1]
 
             ax.hlines(y=i,xmin=xmin_j,xmax=xmax_j,linewidth=1,colors=colors[i])
     
@@ -121,23 +469,80 @@ def plot_accesses(ax,t,accesses):
 
 # Orbital Mechanics Classes
 
+class _TrajectoryState():
+    '''
+    Unit-free array core of a Trajectory. All orbit and access math runs on
+    these contiguous float64 arrays; Quantity and SkyCoord objects are only
+    built from them at the public API.
+    '''
+    __slots__ = ('dt','pos','vel')
+
+    def __init__(self,dt,pos,vel):
+        self.dt = dt    # (T,) seconds since the first obstime of the unsliced trajectory
+        self.pos = pos  # (T,3) position in meters
+        self.vel = vel  # (T,3) velocity in meters per second
+
+def _velocity_component(i,name):
+    '''
+    Property exposing column i of the trajectory velocity array as a
+    Quantity in m/s. Assigned values are broadcast over all obstimes.
+    '''
+    def getter(self):
+        return self._state.vel[:,i] * (u.m/u.s)
+    def setter(self,value):
+        self._state.vel[:,i] = u.Quantity(value).to_value(u.m/u.s)
+    return property(getter,setter,doc=name + ' velocity component (m/s).')
+
 class Trajectory(SkyCoord):
     def __init__(self,t,x,y,z,
                  *args, copy=True, 
                  V_x=0*u.m/u.s, V_y=0*u.m/u.s, V_z=0*u.m/u.s,
                  **kwargs):
-        super().__init__(x=x,
-                         y=y,
-                         z=z,
+        pos = _stack_xyz(x,y,z,u.m)
+        vel = np.empty_like(pos)
+        vel[...] = _stack_xyz(V_x,V_y,V_z,u.m/u.s)
+        dt = np.atleast_1d((t - t.ravel()[0]).to_value(u.s))
+        self._state = _TrajectoryState(dt,pos,vel)
+
+        # the SkyCoord shares its data with the array core
+        xyz = CartesianRepresentation(u.Quantity(pos.T,u.m,copy=False),copy=False)
+        super().__init__(xyz,
                          obstime=t,
                          representation_type='cartesian',
                          frame='gcrs',
+                         copy=False,
                          *args, **kwargs)
+    
+    V_x = _velocity_component(0,'x')
+    V_y = _velocity_component(1,'y')
+    V_z = _velocity_component(2,'z')
+    
+    def _apply(self,method,*args,**kwargs):
+        '''
+        Slices, reshapes and copies (e.g. orb[:100]) build the new object
+        without __init__, so apply the same method to the array core and to
+        any per-obstime arrays of subclasses, and carry over the other
+        attributes. Times in the new array core keep the original epoch.
+        '''
+        new = super()._apply(method,*args,**kwargs)
+        
+        index = np.arange(len(self._state.dt))
+        if callable(method):
+            index = method(index,*args,**kwargs)
+        else:
+            index = getattr(index,method)(*args,**kwargs)
+        index = np.atleast_1d(index).ravel()
         
-        if V_x > 0*u.m/u.s:
-            self.V_x = V_x
-            self.V_y = V_y
-            self.V_z = V_z
+        for key,value in self.__dict__.items():
+            if key in new.__dict__:
+                continue
+            if isinstance(value,np.ndarray) and value.shape[:1] == (len(self._state.dt),):
+                value = value[index]
+            new.__dict__[key] = value
+        new._state = _TrajectoryState(self._state.dt[index],
+                                      self._state.pos[index],
+                                      self._state.vel[index])
+        return new
     
     def separation_vec(self,space_object):
         sc_xyz = _get_xyz(self)
@@ -173,55 +578,325 @@ class Trajectory(SkyCoord):
 
         '''
         
-        # Parse *args into celestial objects and object radii
-        objects = [obj for obj in args[::2]]
-        radii = [radius for radius in args[1::2]]
-        
-        # Instantiate empty DataFrame where each column will represent pulsar
-        # obfuscation by a different celestial body
-        access_df = pd.DataFrame()
-        
-        # For each celestial body, calculate pulsar access
-        for i in range(int(len(args)/2)):
-            space_object = objects[i]
-            object_rad = radii[i]
-        
-            s2o_vec = self.separation_vec(space_object)
-            s2p_vec = self.separation_vec(pulsar)
-            
-            # s2o = self.separation_3d(space_object) # not working for some reason
-            s2o_norm = np.linalg.norm(s2o_vec,axis=1)
-            
-            # sin(ang_s) = object_rad / s2o
-            ang_S = np.arcsin(object_rad / s2o_norm)
-            
-            # tan(ang_BP) = ||s2p_vec x s2o_vec|| / (s2p dot s2o)
-            cross = np.linalg.norm(np.cross(s2o_vec,s2p_vec),axis=1)
-            dot = np.diag(np.dot(s2p_vec,s2o_vec.T))
-            ang_BP = np.arctan2(cross,dot)
-            
-            access_obj = ang_BP > ang_S
-            access_df[str(i)] = access_obj
-        
-        # Find truth value across each row for pulsar access at each obstime
-        access = access_df.all(axis=1)
-        return np.array(access)
-    
+        objects_xyz, radii = _parse_bodies(args)
+        sc_xyz = self._state.pos
+        p_xyz = _xyz_m(pulsar)
+
+        access = _access_matrix(sc_xyz,p_xyz[np.newaxis],objects_xyz,radii)
+        return access[0]
+
+    def pulsar_access_matrix(self,pulsars,*args):
+        '''
+        Returns a (P,T) array of bool values representing when the spacecraft
+        does and does not have access to each of P pulsars, evaluated for all
+        pulsars and all celestial bodies in a single vectorized pass.
+
+        Parameters
+        ----------
+        pulsars : astropy.table.QTable, SkyCoord or numpy.array
+            P pulsars, as a catalog QTable with columns RAJD and DECJD, as a
+            SkyCoord of shape (P,), or as a (P,3) matrix of unit direction
+            vectors from catalog_directions. Pulsars are treated as
+            infinitely distant.
+        *args : tuple
+            Celestial bodies to consider when calculating pulsar access, and
+            their respective radii. Elements of args should alternate in type
+            between astropy.coordinates.SkyCoord and Quantity (distance).
+
+        Returns
+        -------
+        access : numpy.array
+            (P,T) array of bool values representing pulsar access at
+            corresponding index in spacecraft time array.
+
+        '''
+        objects_xyz, radii = _parse_bodies(args)
+        directions = _as_directions(pulsars)
+
+        return _direction_access_matrix(self._state.pos,directions,
+                                        objects_xyz,radii)
+
+    def _access_table(self,accesses,start=0,stop=None):
+        '''
+        Builds the access DataFrame exported to CSV for obstimes start:stop,
+        indexed by the position of each obstime in the full trajectory.
+        '''
+        import pandas as pd
+        sl = slice(start,stop)
+        jd = self.obstime[sl].jd
+        pos_km = self._state.pos[sl] * 1e-3
+        vel_kmps = self._state.vel[sl] * 1e-3
+
+        return pd.DataFrame({'Time_JDate':jd,
+                             'Spacecraft_pos_X_km':pos_km[:,0],
+                             'Spacecraft_pos_Y_km':pos_km[:,1],
+                             'Spacecraft_pos_Z_km':pos_km[:,2],
+                             'Spacecraft_vel_X_kmps':vel_kmps[:,0],
+                             'Spacecraft_vel_Y_kmps':vel_kmps[:,1],
+                             'Spacecraft_vel_Z_kmps':vel_kmps[:,2],
+                             **accesses},
+                            index=pd.RangeIndex(start,start+len(jd)))
+
+    def iter_access_blocks(self,pulsar_qtbl,*args,block_size=10000):
+        '''
+        Calculates pulsar access in consecutive blocks of obstimes, yielding
+        one access DataFrame per block. Peak memory depends on block_size and
+        the number of pulsars, not on the length of the trajectory.
+
+        Parameters
+        ----------
+        pulsar_qtbl : astropy.table.QTable
+            QTable of pulsars and their coordinates, with columns NAME, RAJD,
+            and DECJD.
+        *args : tuple
+            Celestial bodies to consider when calculating pulsar access, and
+            their respective radii. Elements of args should alternate in type
+            between astropy.coordinates.SkyCoord and Quantity (distance).
+        block_size : int, optional
+            Number of obstimes per block. The default is 10000.
+
+        Yields
+        ------
+        pandas.DataFrame
+            Rows start:stop of the table pulsar_access_export would create,
+            with the same columns and index.
+
+        '''
+        directions = catalog_directions(pulsar_qtbl)
+        names = pulsar_qtbl['NAME']
+        objects_xyz, radii = _parse_bodies(args)
+        sc_xyz = self._state.pos
+
+        for start in range(0,len(sc_xyz),int(block_size)):
+            stop = min(start + int(block_size),len(sc_xyz))
+
+            block_objects_xyz = [o_xyz[start:stop] if o_xyz.ndim > 1 else o_xyz
+                                 for o_xyz in objects_xyz]
+            access = _direction_access_matrix(sc_xyz[start:stop],directions,
+                                              block_objects_xyz,radii)
+
+            yield self._access_table(dict(zip(names,access)),start,stop)
+
+    def pulsar_access_stream(self,pulsar_qtbl,*args,
+                             block_size=10000,csv_name='access.csv'):
+        '''
+        Streaming version of pulsar_access_export for long trajectories.
+        Access is calculated block by block and each block is appended to the
+        CSV as soon as it is ready, so the full access table is never held in
+        memory. The resulting file matches the CSV written by
+        pulsar_access_export.
+
+        Parameters
+        ----------
+        pulsar_qtbl : astropy.table.QTable
+            QTable of pulsars and their coordinates, with columns NAME, RAJD,
+            and DECJD.
+        *args : tuple
+            Celestial bodies to consider when calculating pulsar access, and
+            their respective radii. Elements of args should alternate in type
+            between astropy.coordinates.SkyCoord and Quantity (distance).
+        block_size : int, optional
+            Number of obstimes per block. The default is 10000.
+        csv_name : str, optional
+            Filename of pulsar access CSV. The default is 'access.csv'.
+
+        Returns
+        -------
+        None.
+
+        '''
+        blocks = self.iter_access_blocks(pulsar_qtbl,*args,
+                                         block_size=block_size)
+        for i,block_df in enumerate(blocks):
+            block_df.to_csv(csv_name,mode='w' if i == 0 else 'a',
+                            header=(i == 0))
+
+    def _xyz_at(self,dt):
+        '''
+        Evaluates the spacecraft position at arbitrary times by linear
+        interpolation between obstimes. Subclasses with an orbit model
+        override this to evaluate the model directly.
+
+        Parameters
+        ----------
+        dt : array_like
+            Seconds since the first obstime.
+
+        Returns
+        -------
+        numpy.array
+            len(dt) x 3 array of x,y,z coordinates in meters.
+
+        '''
+        t_grid = self._state.dt
+        sc_xyz = self._state.pos
+        return np.stack([np.interp(dt,t_grid,sc_xyz[:,i]) for i in range(3)],
+                        axis=-1)
+
+    def find_access_events(self,pulsar_qtbl,*args,tol=1*u.s):
+        '''
+        Finds the occultation intervals of each pulsar by each celestial body.
+        A coarse access pass over the obstimes locates sign changes of the
+        margin ang_BP - ang_S, and each crossing is then refined by bisection
+        on the trajectory model until it is known to within tol.
+
+        The obstimes only need to be dense enough not to step over an entire
+        occultation; occultations shorter than the obstime spacing can be
+        missed. Body positions are linearly interpolated between obstimes
+        during refinement.
+
+        Parameters
+        ----------
+        pulsar_qtbl : astropy.table.QTable
+            QTable of pulsars and their coordinates, with columns NAME, RAJD,
+            and DECJD.
+        *args : tuple
+            Celestial bodies to consider when calculating pulsar access, and
+            their respective radii. Elements of args should alternate in type
+            between astropy.coordinates.SkyCoord and Quantity (distance).
+        tol : Quantity (time), optional
+            Time tolerance of the refined ingress and egress times. The
+            default is 1 second.
+
+        Returns
+        -------
+        events : pandas.DataFrame
+            One row per occultation, with the pulsar name, the index of the
+            occulting body in *args, and the ingress and egress Julian dates
+            and duration in seconds. Occultations already in progress at the
+            first obstime or still in progress at the last obstime are
+            clipped to the trajectory.
+
+        '''
+        import pandas as pd
+        names = np.asarray(pulsar_qtbl['NAME'])
+        objects_xyz, radii = _parse_bodies(args)
+        sc_xyz = self._state.pos
+        directions = catalog_directions(pulsar_qtbl)
+
+        t_grid = self._state.dt
+        tol = u.Quantity(tol).to_value(u.s)
+
+        rows = []
+        for b,(o_xyz,object_rad) in enumerate(zip(objects_xyz,radii)):
+            visible = _direction_margin(sc_xyz,directions,o_xyz,
+                                        object_rad) > 0
+
+            # bracket every change in visibility between obstimes i and i+1
+            p_idx,i_idx = np.nonzero(visible[:,1:] != visible[:,:-1])
+            lo = t_grid[i_idx]
+            hi = t_grid[i_idx+1]
+            vis_lo = visible[p_idx,i_idx]
+
+            while len(lo) > 0 and np.max(hi - lo) > tol:
+                mid = 0.5*(lo + hi)
+                frac = ((mid - t_grid[i_idx]) /
+                        (t_grid[i_idx+1] - t_grid[i_idx]))[:,np.newaxis]
+
+                o_mid = o_xyz if o_xyz.ndim == 1 else \
+                        _lerp(o_xyz[i_idx],o_xyz[i_idx+1],frac)
+
+                s2o_vec = o_mid - self._xyz_at(mid)
+                dot = np.einsum('ij,ij->i',directions[p_idx],s2o_vec)
+                vis_mid = _limb_margin(s2o_vec,dot,object_rad) > 0
+                same = vis_mid == vis_lo
+                lo = np.where(same,mid,lo)
+                hi = np.where(same,hi,mid)
+
+            t_cross = 0.5*(lo + hi)
+
+            # pair ingresses with egresses, clipping at the trajectory ends
+            start_p = np.nonzero(~visible[:,0])[0]
+            stop_p = np.nonzero(~visible[:,-1])[0]
+            ingress_p = np.concatenate([start_p,p_idx[vis_lo]])
+            ingress_t = np.concatenate([np.full(len(start_p),t_grid[0]),
+                                        t_cross[vis_lo]])
+            egress_p = np.concatenate([p_idx[~vis_lo],stop_p])
+            egress_t = np.concatenate([t_cross[~vis_lo],
+                                       np.full(len(stop_p),t_grid[-1])])
+
+            order_in = np.lexsort((ingress_t,ingress_p))
+            order_out = np.lexsort((egress_t,egress_p))
+
+            rows.append(pd.DataFrame({'Pulsar':names[ingress_p[order_in]],
+                                      'Body':b,
+                                      'Ingress_s':ingress_t[order_in],
+                                      'Egress_s':egress_t[order_out]}))
+
+        if rows:
+            events = pd.concat(rows,ignore_index=True)
+        else:
+            events = pd.DataFrame(columns=['Pulsar','Body',
+                                           'Ingress_s','Egress_s'])
+
+        # t_grid counts from the epoch of the unsliced trajectory
+        jd_0 = self.obstime.ravel()[0].jd - t_grid[0]/86400
+        return pd.DataFrame({'Pulsar':events['Pulsar'],
+                             'Body':events['Body'],
+                             'Ingress_JDate':jd_0 + events['Ingress_s']/86400,
+                             'Egress_JDate':jd_0 + events['Egress_s']/86400,
+                             'Duration_s':events['Egress_s'] - events['Ingress_s']})
+
+    def _pulsar_access_parallel(self,pulsar_qtbl,*args,
+                                n_workers=None,chunk_size=256):
+        '''
+        Calculates the (P,T) access matrix of pulsar_access_export on a
+        process pool, sharding the pulsar catalog into chunks of chunk_size
+        rows. The spacecraft, body and pulsar direction arrays and the output
+        matrix live in shared memory, so only row ranges are sent to the
+        workers. Each chunk writes its own rows, so the result does not depend
+        on the number of workers or the chunk size.
+        '''
+        objects_xyz, radii = _parse_bodies(args)
+        n_pulsars = len(pulsar_qtbl)
+        arrays = {'sc_xyz':self._state.pos,
+                  'directions':catalog_directions(pulsar_qtbl),
+                  'access':np.zeros((n_pulsars,len(self)),dtype=bool)}
+        for i,o_xyz in enumerate(objects_xyz):
+            arrays['body'+str(i)] = o_xyz
+
+        blocks = {}
+        try:
+            for key,arr in arrays.items():
+                blocks[key] = _share_array(arr)
+            specs = {key:spec for key,(shm,spec) in blocks.items()}
+
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = [pool.submit(_access_worker,specs,start,stop,radii)
+                           for start,stop in
+                           ((i,min(i+chunk_size,n_pulsars))
+                            for i in range(0,n_pulsars,chunk_size))]
+                for future in futures:
+                    future.result()
+
+            shm,spec = blocks['access']
+            access = np.ndarray(spec[1],dtype=spec[2],buffer=shm.buf).copy()
+        finally:
+            for shm,spec in blocks.values():
+                shm.close()
+                shm.unlink()
+
+        return access
+
     def pulsar_access_export(self,pulsar_qtbl,*args,
                              make_csv=True, save_csv=True, csv_name = 'access.csv',
-                             make_fig=False, save_fig=True, fig_name = 'access.png'):
+                             make_fig=False, save_fig=True, fig_name = 'access.png',
+                             n_workers=1, chunk_size=256):
         '''
         Exports pulsar access data for a given pulsar accounting for 
         obfuscation from a given celestial body. The default is to create and 
         export a CSV, and the option to create and export a PNG plot is 
-        included.
+        included. For trajectories too long to hold in memory, see
+        pulsar_access_stream.
 
         Parameters
         ----------
         pulsar_qtbl : astropy.table.QTable
             QTable of pulsars and their coordinates. It is assumed that pulsar 
-            QTables are given with columns NAME, RAJD, DECJD, and DIST, since
-            these are the default column names given by the psrqpy package.
+            QTables are given with columns NAME, RAJD, and DECJD, since these
+            are the default column names given by the psrqpy package. Pulsars
+            are treated as infinitely distant; see catalog_directions.
         *args : tuple
             Celestial bodies to consider when calculating pulsar access, and 
             their respective radii. Elements of args should alternate in type
@@ -244,40 +919,42 @@ class Trajectory(SkyCoord):
             Filename of pulsar access plot PNG. The default is 'access.png',
             the file is only created if save_fig is True.
 
+        n_workers : int, optional
+            Number of worker processes to shard the pulsar catalog across.
+            The default is 1, which calculates access in this process. None
+            uses one worker per CPU. When running with more than one worker
+            on Windows, call this method from under an
+            ``if __name__ == '__main__':`` guard.
+        chunk_size : int, optional
+            Number of pulsars handed to a worker at a time. The default is
+            256. Only used when n_workers is not 1.
+
         Returns
         -------
         tuple (pandas.DataFrame, 
                (matplotlib.pyplot.Figure,matplotlib.pyplot.Axes))
             Tuple of access DataFrame and/or access plot.
         '''
-        # convert each row of QTable to GCRS cartesian SkyCoord and calculate
-        # pulsar access for each one
-        accesses = {}
-        for pulsar in pulsar_qtbl:
-            pulsar_sc = SkyCoord(ra = pulsar['RAJD'],
-                          dec = pulsar['DECJD'],
-                          distance = pulsar['DIST'])
-            pulsar_sc = pulsar_sc.transform_to(self)
-            
-            pulsar_access = self.pulsar_access(pulsar_sc,*args)
-            accesses[pulsar['NAME']] = pulsar_access
+        # convert the whole QTable to one direction matrix and calculate
+        # pulsar access for every pulsar at once
+        if n_workers == 1:
+            access = self.pulsar_access_matrix(pulsar_qtbl,*args)
+        else:
+            access = self._pulsar_access_parallel(pulsar_qtbl,*args,
+                                                  n_workers=n_workers,
+                                                  chunk_size=chunk_size)
+        accesses = dict(zip(pulsar_qtbl['NAME'],access))
         
         # export CSV and plot PNG, if enabled in method call
         if make_csv:
-            accesses_df = pd.DataFrame({'Time_JDate':self.obstime.jd,
-                                        'Spacecraft_pos_X_km':self.x.to(u.km),
-                                        'Spacecraft_pos_Y_km':self.y.to(u.km),
-                                        'Spacecraft_pos_Z_km':self.z.to(u.km),
-                                        'Spacecraft_vel_X_kmps':self.V_x.to(u.km/u.s),
-                                        'Spacecraft_vel_Y_kmps':self.V_y.to(u.km/u.s),
-                                        'Spacecraft_vel_Z_kmps':self.V_z.to(u.km/u.s),
-                                        **accesses})
+            accesses_df = self._access_table(accesses)
             if save_csv:
                 accesses_df.to_csv(csv_name)
         else:
             accesses_df = None
 
         if make_fig:
+            import matplotlib.pyplot as plt
             fig,ax = plt.subplots()
             ax = plot_accesses(ax, self.obstime, accesses)
             fig.set_figwidth(10)
@@ -295,7 +972,7 @@ class EllipticalOrbit(Trajectory):
     def __init__(self,t,a,e,v_0=0*u.deg,M_body=M_Earth, # default body Earth
                  inc=0*u.deg,w=0*u.deg, # if you want to input orbital elements directly
                  B=None,dec=None,       # if you want to calculate orbital elements from orbital insertion
-                 hifi=False,
+                 hifi=False,kepler_tol=1e-12,kepler_max_iter=50,
                  Omega=0*u.deg,lambda2=None): # direct input of ascending node longitude vs. calculate from burnout longitude
         '''
         Initialization function for elliptical_orbit object.
@@ -339,6 +1016,12 @@ class EllipticalOrbit(Trajectory):
         hifi : bool, optional
             Tells the function whether to use the hi-fidelity version of the 
             eccentric anomaly calculation. The default is False.
+        kepler_tol : float, optional
+            Convergence tolerance in radians of the hi-fidelity Kepler
+            solver. The default is 1e-12.
+        kepler_max_iter : int, optional
+            Maximum number of iterations of the hi-fidelity Kepler solver.
+            The default is 50.
             
         Omega : Quantity (angle), optional
             Longitude of ascending node. The default is 0 degrees.
@@ -355,6 +1038,10 @@ class EllipticalOrbit(Trajectory):
         self.a = a
         self.e = e
         self.v_0 = v_0
+        self.M_body = M_body
+        self.hifi = hifi
+        self.kepler_tol = kepler_tol
+        self.kepler_max_iter = kepler_max_iter
         
         if B != None:
             self.B = B
@@ -381,25 +1068,6 @@ class EllipticalOrbit(Trajectory):
         self.M_0 = self.E_0 - e * np.sin(self.E_0) * u.rad  # initial mean anomaly at t_0
         self.n = np.sqrt(G*M_body / a**3) * u.rad           # mean motion, or average angular velocity
         
-        delta_t = t - t[0]
-        self.M_t = self.n*delta_t + self.M_0
-        
-        if hifi == True:
-            self.E = self._calc_E(self.M_t,self.E_0, self.e)
-            self.v = np.arccos((np.cos(self.E) - self.e) /   # anomoly as a 
-                               (1 - self.e*np.cos(self.E)))  # function of t
-        else:
-            self.v = self.M_t + 2 * e * np.sin(self.M_t) * u.rad \
-                              + 1.25 * e**2 * np.sin(2*self.M_t) * u.rad # lofi anomaly
-            
-        self.r_t = a*(1-e**2)/(1+e*np.cos(self.v))
-        
-        
-        # Calculate x, y, z assuming ascending node at vernal equinox
-        xyz_coords = u.Quantity([self.r_t * np.cos(self.v) * np.cos(self.inc),
-                                 self.r_t * np.sin(self.v),
-                                 self.r_t * np.sin(self.v) * np.sin(self.inc)]).T
-        
         # Calculate and account for non-zero longitude of ascending node
         
         if lambda2 != None:
@@ -409,55 +1077,191 @@ class EllipticalOrbit(Trajectory):
         else:
             self.Omega = Omega
         
-        xyz_coords_rot = _rotate(xyz_coords,self.Omega,self.inc,self.w)
-        [x,y,z] = [xyz_coords_rot[:,i] for i in range(3)]
+        # unit-free orbital elements (SI units, radians) for the array core
+        self._a = u.Quantity(a).to_value(u.m)
+        self._GM = (G*M_body).to_value(u.m**3/u.s**2)
+        self._M_0 = _rad(self.M_0)
+        self._n = self.n.to_value(u.rad/u.s)
+        self._Omega = _rad(self.Omega)
+        self._inc = _rad(self.inc)
+        self._w = _rad(self.w)
+        
+        dt = (t - t[0]).to_value(u.s)
+        M = self._n*dt + self._M_0
+        
+        if hifi == True:
+            self._E = self._calc_E(M,self.e)
+            self._v = self._true_anomaly(M,self._E)
+        else:
+            self._v = self._true_anomaly(M)
         
-        super().__init__(t,x,y,z)
+        xyz_coords_rot = self._orbit_xyz(self._v)
+        [x,y,z] = [u.Quantity(xyz_coords_rot[:,i],u.m,copy=False) for i in range(3)]
         
-        self.ang = np.arctan(e*np.sin(self.v)/(1+e*np.cos(self.v))) # flight-path angle at any point
-        self.V = np.sqrt(G*M_body*((2/self.r_t)-(1/a)))                   # spacecraft velocity at any point
+        # spacecraft velocity at any point
+        V = self._speed(self._v)
+        V_x = V * np.cos(self._v) * np.cos(self._inc)
+        V_y = V * np.sin(self._v)
+        V_z = V * np.sin(self._v) * np.sin(self._inc)
         
-        self.V_x = self.V * np.cos(self.v) * np.cos(self.inc)
-        self.V_y = self.V * np.sin(self.v)
-        self.V_z = self.V * np.sin(self.v) * np.sin(self.inc)
+        super().__init__(t,x,y,z,V_x=V_x*u.m/u.s,V_y=V_y*u.m/u.s,V_z=V_z*u.m/u.s)
+    
+    # Per-obstime orbit quantities are built from the array core on access
     
+    @property
+    def M_t(self):
+        '''Mean anomaly as a function of t.'''
+        return (self._n*self._state.dt + self._M_0) * u.rad
     
-    def _calc_E(self,M,E_0,e):
+    @property
+    def E(self):
+        '''Eccentric anomaly as a function of t (hifi only).'''
+        return self._E * u.rad
+    
+    @property
+    def v(self):
+        '''True anomaly as a function of t.'''
+        return self._v * u.rad
+    
+    @property
+    def r_t(self):
+        '''Orbital radius as a function of t.'''
+        return self._radius(self._v) * u.m
+    
+    @property
+    def ang(self):
+        '''Flight-path angle at any point.'''
+        e = self.e
+        return np.arctan(e*np.sin(self._v)/(1+e*np.cos(self._v))) * u.rad
+    
+    @property
+    def V(self):
+        '''Spacecraft velocity at any point.'''
+        return self._speed(self._v) * u.m/u.s
+    
+    def _radius(self,v):
+        '''
+        Orbital radius in meters at true anomalies v (radians).
+        '''
+        e = self.e
+        return self._a*(1-e**2)/(1+e*np.cos(v))
+    
+    def _speed(self,v):
+        '''
+        Orbital speed in m/s at true anomalies v (radians), from vis-viva.
+        '''
+        return np.sqrt(self._GM*((2/self._radius(v))-(1/self._a)))
+    
+    def _true_anomaly(self,M,E=None):
+        '''
+        Calculates true anomaly as a function of mean anomaly, using the hifi
+        or lofi model selected at initialization.
+
+        Parameters
+        ----------
+        M : array_like
+            Mean anomaly in radians.
+        E : array_like, optional
+            Eccentric anomaly in radians corresponding to M, if already
+            calculated. Only used by the hifi model. The default is None.
+
+        Returns
+        -------
+        numpy.array
+            True anomaly in radians.
+
+        '''
+        e = self.e
+        if self.hifi == True:
+            if E is None:
+                E = self._calc_E(M,e)
+            return np.arccos((np.cos(E) - e) /   # anomoly as a 
+                             (1 - e*np.cos(E)))  # function of t
+        else:
+            return M + 2 * e * np.sin(M) \
+                     + 1.25 * e**2 * np.sin(2*M) # lofi anomaly
+
+    def _orbit_xyz(self,v):
+        '''
+        Calculates rotated cartesian coordinates along the orbit at the given
+        true anomalies.
+
+        Parameters
+        ----------
+        v : array_like
+            True anomaly in radians.
+
+        Returns
+        -------
+        numpy.array
+            len(v) x 3 array of x,y,z coordinates in meters.
+
+        '''
+        r_t = self._radius(v)
+
+        # Calculate x, y, z assuming ascending node at vernal equinox
+        xyz_coords = np.stack([r_t * np.cos(v) * np.cos(self._inc),
+                               r_t * np.sin(v),
+                               r_t * np.sin(v) * np.sin(self._inc)],axis=-1)
+
+        return _rotate(xyz_coords,self._Omega,self._inc,self._w)
+
+    def _xyz_at(self,dt):
+        '''
+        Evaluates the orbit model at arbitrary times, rather than
+        interpolating between obstimes.
+
+        Parameters
+        ----------
+        dt : array_like
+            Seconds since the first obstime.
+
+        Returns
+        -------
+        numpy.array
+            len(dt) x 3 array of x,y,z coordinates in meters.
+
+        '''
+        M = self._n*np.asarray(dt,dtype=float) + self._M_0
+        E = None
+        if self.hifi == True:
+            # solve directly: n_unconverged describes the obstimes only
+            E, n_failed = _solve_kepler(M,self.e,self.kepler_tol,
+                                        self.kepler_max_iter)
+            if n_failed > 0:
+                warnings.warn('Kepler solver did not converge at {} of {} '
+                              'refinement epochs; access event times may be '
+                              'inaccurate.'.format(n_failed,np.size(M)))
+        return self._orbit_xyz(self._true_anomaly(M,E))
+
+    def _calc_E(self,M,e):
         '''
         Calculates eccentric anomaly as a function of M at each obstime.
-        Used only in the high fidelity version of the class.
+        Used only in the high fidelity version of the class. The number of
+        obstimes at which the solver did not converge is stored in
+        n_unconverged.
 
         Parameters
         ----------
-        M : Quantity array (angle)
-            Mean anomaly as a function of t.
-        E_0 : Quantity (angle)
-            Initial eccentric anomaly.
+        M : array_like
+            Mean anomaly in radians as a function of t.
         e : float
             Eccentricity of orbit.
 
         Returns
         -------
-        Quantity array (angle)
-            Eccentric anomaly array.
+        numpy.array
+            Eccentric anomaly array in radians.
 
         '''
-        E_list = []
-        
-        E = Symbol('E')
-        E_temp = nsolve(E - (e * sin(E)) - float(M[0].to(u.rad)/u.rad),
-                        E,
-                        float(E_0.to(u.rad)/u.rad))
-        E_list.append(E_temp)
+        E, self.n_unconverged = _solve_kepler(M,e,
+                                              self.kepler_tol,
+                                              self.kepler_max_iter)
+        if self.n_unconverged > 0:
+            warnings.warn('Kepler solver did not converge at {} of {} '
+                          'obstimes.'.format(self.n_unconverged,E.size))
         
-        for i in range(1,len(M)):
-            E_last = E_list[-1]
-            E_temp = nsolve(E - e*sin(E) - float(M[i].to(u.rad)/u.rad),
-                            E,
-                            E_last)
-            E_list.append(E_temp)
-        
-        return np.array(E_list)*u.rad
+        return E
     
 class CircularOrbit(EllipticalOrbit):
     def __init__(self,t,r,v_0=0*u.deg,M_body=M_Earth):
@@ -489,10 +1293,208 @@ class CircularOrbit(EllipticalOrbit):
         super().__init__(t,a,e,v_0,M_body)
         
         self.r = r
-        
-        self.V = np.sqrt(G*M_body/r)
         self.W = self.V/r * u.rad
         
-        self.V_x = self.V * np.cos(self.v)
-        self.V_y = self.V * np.sin(self.v)
-        self.V_z = 0 * u.m / u.s
\ No newline at end of file
+        self.V_z = 0 * u.m / u.s
+    
+    @property
+    def V(self):
+        '''Spacecraft velocity, constant along a circular orbit.'''
+        return np.sqrt(self._GM/self._a) * u.m/u.s
+
+# Ephemeris Classes
+
+class BodyEphemeris():
+    def __init__(self,body,start,stop,frame='gcrs',
+                 segment=1*u.day,degree=12,
+                 cache_dir='ephemeris_cache',ephemeris=None):
+        '''
+        Cached, interpolated ephemeris of a solar system body for use as an
+        occulting body in the pulsar access methods.
+
+        The body is evaluated once with astropy get_body on a coarse grid of
+        Chebyshev nodes, and each segment of the span is fitted with a
+        Chebyshev polynomial per coordinate. The coefficients are stored in a
+        .npy file in cache_dir, keyed by body, frame, span, segment length,
+        degree and ephemeris, and memory-mapped on later runs so that
+        trade-study variants over the same span never call get_body again.
+
+        Error bound: after fitting, the interpolant is checked against
+        get_body at three points between each pair of fit nodes and at the
+        segment ends. The largest deviation, times a safety factor of 2, is
+        stored as max_error. The deviation between check points can be 
+        somewhat larger than at them (up to 1.25 times against 5001 epochs,
+        over 10 to 365 day spans of the Moon, the Sun and Mars), which the 
+        factor covers. With the default 1 day segments and degree 12, 
+        max_error is 2 to 3 cm for the Moon and the Sun in GCRS, well below
+        the positional accuracy of the builtin ephemeris itself.
+
+        Parameters
+        ----------
+        body : str
+            Name of the body, as accepted by astropy.coordinates.get_body.
+        start : Time
+            Start of the span to be served.
+        stop : Time
+            End of the span to be served.
+        frame : str, optional
+            Frame the positions are served in. The default is 'gcrs', the
+            frame of Trajectory.
+        segment : Quantity (time), optional
+            Length of each polynomial segment. The default is 1 day.
+        degree : int, optional
+            Degree of the Chebyshev polynomial fitted to each segment. The
+            default is 12.
+        cache_dir : str, optional
+            Directory of the cache files. The default is 'ephemeris_cache'.
+        ephemeris : str, optional
+            Ephemeris passed to get_body. The default is None, which uses the
+            astropy default.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.body = body.lower()
+        self.frame = frame
+        self.start = start
+        self.degree = int(degree)
+        self.ephemeris = ephemeris
+
+        self.segment = u.Quantity(segment).to_value(u.s)
+        span = (stop - start).to_value(u.s)
+        self.n_segments = max(int(np.ceil(span / self.segment)),1)
+
+        # the leading version invalidates cache files written before
+        # max_error included the safety factor
+        key = '|'.join(['2',self.body,frame,start.tt.isot,stop.tt.isot,
+                        repr(self.segment),str(self.degree),str(ephemeris)])
+        name = '{}_{}_{}'.format(self.body,frame,
+                                 hashlib.sha1(key.encode()).hexdigest()[:16])
+        self.cache_file = os.path.join(cache_dir,name + '.npy')
+        meta_file = os.path.join(cache_dir,name + '.json')
+
+        if not (os.path.exists(self.cache_file) and os.path.exists(meta_file)):
+            coeffs, max_error = self._fit()
+            os.makedirs(cache_dir,exist_ok=True)
+
+            # write to temporary files first so readers never see a partial
+            # cache entry
+            tmp = self.cache_file + '.' + str(os.getpid())
+            with open(tmp,'wb') as f:
+                np.save(f,coeffs)
+            os.replace(tmp,self.cache_file)
+            with open(tmp,'w') as f:
+                json.dump({'key':key,'max_error_m':max_error},f)
+            os.replace(tmp,meta_file)
+
+        self.coeffs = np.load(self.cache_file,mmap_mode='r')
+        with open(meta_file) as f:
+            self.max_error = json.load(f)['max_error_m'] * u.m
+
+    def _body_xyz(self,tau):
+        '''
+        Evaluates the body with get_body at tau seconds after start and
+        returns its positions in the requested frame as a (N,3) float array
+        in meters.
+        '''
+        t = self.start + tau*u.s
+        sc = get_body(self.body,t,ephemeris=self.ephemeris)
+        if self.frame != 'gcrs':
+            sc = sc.transform_to(self.frame)
+        return sc.cartesian.xyz.to_value(u.m).T
+
+    def _fit(self):
+        '''
+        Fits every segment with Chebyshev polynomials, using a single
+        get_body call for all fit nodes and another for all check points.
+
+        Returns
+        -------
+        coeffs : numpy.array
+            (n_segments, 3, degree+1) array of Chebyshev coefficients.
+        max_error : float
+            Largest deviation in meters between the fit and get_body at the
+            check points, times a safety factor of 2.
+
+        '''
+        n_nodes = 2*(self.degree + 1)
+        k = np.arange(n_nodes)
+        nodes = -np.cos((2*k + 1) * np.pi / (2*n_nodes))  # Chebyshev nodes on [-1, 1]
+        gaps = np.array([0.25,0.5,0.75])[:,np.newaxis]
+        checks = np.concatenate(([-1.0],(nodes[:-1] + gaps*np.diff(nodes)).ravel(),[1.0]))
+
+        seg_start = np.arange(self.n_segments)[:,np.newaxis] * self.segment
+        to_tau = lambda x: (seg_start + 0.5*(x + 1)*self.segment).ravel()
+
+        node_xyz = self._body_xyz(to_tau(nodes)).reshape(self.n_segments,
+                                                         n_nodes,3)
+        coeffs = np.stack([np.polynomial.chebyshev.chebfit(nodes,xyz,
+                                                           self.degree).T
+                           for xyz in node_xyz])
+
+        check_tau = to_tau(checks)
+        check_xyz = self._body_xyz(check_tau)
+        max_error = 2*np.max(np.linalg.norm(self._interp(check_tau,coeffs)
+                                            - check_xyz,axis=-1))
+
+        return coeffs, float(max_error)
+
+    def _interp(self,tau,coeffs):
+        '''
+        Evaluates the piecewise Chebyshev interpolant at tau seconds after
+        start with Clenshaw's recurrence, vectorized over all epochs.
+        '''
+        tau = np.atleast_1d(tau)
+        idx = np.clip((tau // self.segment).astype(int),0,self.n_segments-1)
+        x = (2*(tau - idx*self.segment) / self.segment - 1)[:,np.newaxis]
+        c = coeffs[idx]
+
+        b1 = np.zeros((len(tau),3))
+        b2 = np.zeros((len(tau),3))
+        for j in range(self.degree,0,-1):
+            b1, b2 = 2*x*b1 - b2 + c[:,:,j], b1
+        return x*b1 - b2 + c[:,:,0]
+
+    def xyz(self,t):
+        '''
+        Returns interpolated body positions at the given times.
+
+        Parameters
+        ----------
+        t : Time
+            Times within the span of the ephemeris.
+
+        Returns
+        -------
+        numpy.array
+            len(t) x 3 array of x,y,z coordinates in meters.
+
+        '''
+        tau = np.atleast_1d((t - self.start).to_value(u.s))
+        span = self.n_segments * self.segment
+        if np.any(tau < 0) or np.any(tau > span):
+            raise ValueError('Requested times fall outside the span of the '
+                             'cached {} ephemeris.'.format(self.body))
+        return self._interp(tau,self.coeffs)
+
+    def positions(self,t):
+        '''
+        Returns interpolated body positions at the given times as a SkyCoord,
+        which can be passed directly to the pulsar access methods.
+
+        Parameters
+        ----------
+        t : Time
+            Times within the span of the ephemeris.
+
+        Returns
+        -------
+        astropy.coordinates.SkyCoord
+            Cartesian body positions in the ephemeris frame.
+
+        '''
+        x,y,z = self.xyz(t).T * u.m
+        return SkyCoord(x=x,y=y,z=z,obstime=t,frame=self.frame,
+                        representation_type='cartesian')
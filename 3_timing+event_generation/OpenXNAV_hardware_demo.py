@@ -21,7 +21,8 @@ from tkinter import filedialog
 
 def check_indiv_connectivity(sdr1,sdr2,sample_rate,center_freq,
                              plot_rx_pulse_train = True,plot_rx_samples = True,
-                             plot_fft = True,check_fid = True):
+                             plot_fft = True,check_fid = True,backend = None,
+                             plotter = None):
     '''
     Check connectivity and transmission fidelity of individual SDR(s).
 
@@ -47,10 +48,20 @@ def check_indiv_connectivity(sdr1,sdr2,sample_rate,center_freq,
     check_fid : bool, optional
         Specify whether you want to compare the transmitted and received pulse 
         sequences for transmission fidelity. The default is True.
+    backend : callable, optional
+        Radio backend used to open the SDRs, e.g. sdr_io.SimulatedRadios to 
+        run the demo without hardware. The default is None, which uses 
+        physical PlutoSDRs.
+    plotter : sdr_io.DiagnosticsPlotter, optional
+        Background plotter the requested plots are queued to; call its 
+        show() to draw them. The default is None, which draws the plots 
+        before returning.
 
     Returns
     -------
-    None.
+    link : sdr_io.SDRLink
+        Open link from the first to the second SDR, for further 
+        transmissions. Close it when done.
 
     '''
     # Check that both SDRs can transmit and receive data to themselves
@@ -60,12 +71,14 @@ def check_indiv_connectivity(sdr1,sdr2,sample_rate,center_freq,
     sdr_io.sdr_tx_rx(sample_rate,center_freq,
                      sdr1,sdr1,
                      tx_data,tx_length,
-                     False,False, False, False)
+                     False,False, False, False,
+                     backend=backend)
     
     sdr_io.sdr_tx_rx(sample_rate,center_freq,
                      sdr2,sdr2,
                      tx_data,tx_length,
-                     False,False, False, False)
+                     False,False, False, False,
+                     backend=backend)
     
     # Prompt user to connect SDRs together before transmitting between them
     cont = input('Now that you have verified both SDRs can transmit and '
@@ -74,15 +87,19 @@ def check_indiv_connectivity(sdr1,sdr2,sample_rate,center_freq,
                  'SDR. Press Enter when ready to proceed.')
     
     # Now that SDRs are connected, check connectivity and transmission fidelity
+    link = sdr_io.SDRLink(sdr1,sdr2,sample_rate,center_freq,backend=backend)
     sdr_io.sdr_tx_rx(sample_rate,center_freq,
                  sdr1,sdr2,
                  tx_data,tx_length,
-                 plot_rx_pulse_train,plot_rx_samples,plot_fft,check_fid)
+                 plot_rx_pulse_train,plot_rx_samples,plot_fft,check_fid,
+                 link=link,plotter=plotter)
+    
+    return link
     
 def transmit_data(sdr1,sdr2,sample_rate,center_freq,
                   tx_data_name,tx_length,
                   plot_rx_pulse_train = True,plot_rx_samples = True,
-                  plot_fft = True,check_fid = True):
+                  plot_fft = True,check_fid = True,link = None,plotter = None):
     '''
     After generating a pulse train from the OpenXNAV software, transmit it from 
     the "Emitter" SDR to the "Detector" SDR
@@ -113,6 +130,13 @@ def transmit_data(sdr1,sdr2,sample_rate,center_freq,
     check_fid : bool, optional
         Specify whether you want to compare the transmitted and received pulse 
         sequences for transmission fidelity. The default is True.
+    link : sdr_io.SDRLink, optional
+        Open link from sdr1 to sdr2 to transmit through. The default is None,
+        which opens a link for this transmission only.
+    plotter : sdr_io.DiagnosticsPlotter, optional
+        Background plotter the requested plots are queued to; call its 
+        show() to draw them, along with the transmitted data plot. The 
+        default is None, which draws the plots before returning.
 
     Returns
     -------
@@ -122,15 +146,18 @@ def transmit_data(sdr1,sdr2,sample_rate,center_freq,
     tx_data = np.load(tx_data_name)
     tx_data = tx_data[:tx_length]
     
+    plt.figure()
     plt.plot(tx_data)
     plt.title('Transmitted data')
-    plt.show()
+    if plotter is None:
+        plt.show()
     
     print("Received data:")
     sdr_io.sdr_tx_rx(sample_rate,center_freq,
                  sdr1,sdr2,
                  tx_data,tx_length,
-                 plot_rx_pulse_train,plot_rx_samples,plot_fft,check_fid)
+                 plot_rx_pulse_train,plot_rx_samples,plot_fft,check_fid,
+                 link=link,plotter=plotter)
 
 def main():
     # Get SDR IP address(es)
@@ -151,13 +178,22 @@ def main():
     sample_rate = 1e6 # Hz
     center_freq = 915e6 # Hz
     
-    check_indiv_connectivity(sdr1, sdr2, sample_rate, center_freq,
-                             plot_rx_pulse_train = True,plot_rx_samples = True,
-                             plot_fft = True,check_fid = True)
+    # Plots are computed in the background and drawn once at the end, so
+    # they never hold up a capture
+    plotter = sdr_io.DiagnosticsPlotter(sample_rate)
+    
+    link = check_indiv_connectivity(sdr1, sdr2, sample_rate, center_freq,
+                                    plot_rx_pulse_train = True,
+                                    plot_rx_samples = True,
+                                    plot_fft = True,check_fid = True,
+                                    plotter = plotter)
     
     cont = input('SDR connectivity check complete. '
                  'Continue with transmission? [y/n] ')
     if cont == 'n' or cont == 'N' or cont == '':
+        link.close()
+        plotter.show()
+        plotter.close()
         return
     
     # Define raw data to be transmitted
@@ -170,7 +206,11 @@ def main():
     transmit_data(sdr1, sdr2, sample_rate, center_freq, 
                   tx_data_name, tx_length,
                   plot_rx_pulse_train = True,plot_rx_samples = True,
-                  plot_fft = True,check_fid = True)
+                  plot_fft = True,check_fid = True,link = link,
+                  plotter = plotter)
+    link.close()
+    plotter.show()
+    plotter.close()
 
 main()
     
@@ -1,5 +1,9 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+
 import numpy as np
-import adi
 import matplotlib.pyplot as plt
 
 def sinusoid(N=10000,sample_rate=10000,freq=2500):
@@ -45,21 +49,29 @@ def stretch_pulse_train(pulse_train,stretch_factor):
         Stretched pulse train.
 
     '''
-    N = len(pulse_train)*stretch_factor
-    new_pulse_train = np.zeros(N)
-    
-    for i in range(int(stretch_factor)):
-        new_pulse_train[i:N:stretch_factor] = pulse_train
-    
-    return new_pulse_train
+    return np.repeat(np.asarray(pulse_train,dtype=float),int(stretch_factor))
+
+def _symbol_carrier(num_periods,bits_per_period):
+    '''
+    Carrier samples for one pulse symbol: num_periods periods of a complex
+    sinusoid with a period of bits_per_period samples and amplitude 0.5, as
+    in sinusoid. Every symbol of a pulse_train_to_tx waveform starts at the
+    same carrier phase, so this table is reused for all of them.
+    '''
+    n = np.arange(num_periods*bits_per_period)
+    return 0.5*np.exp(2.0j*np.pi*n/bits_per_period)
 
-def pulse_train_to_tx(pulse_train,num_periods=1,bits_per_period=4):
+def pulse_train_to_tx(pulse_train,num_periods=1,bits_per_period=4,
+                      out=None,scale=1):
     '''
     Takes any pulse train (sequence of amplitude vs. time data) and modulates
     it with a sinusoidal wave so that it can be transmitted by an SDR.
     
-    This function uses the stretch_pulse_train function to stretch the pulse
-    train according to the resolution specified by the function arguments.
+    Each pulse is stretched to num_periods*bits_per_period samples and 
+    multiplied by a precomputed single-symbol carrier table, so no 
+    full-length stretched pulse train or carrier is built. For waveforms too
+    long to hold in memory, pass a memory-mapped out array (e.g. from 
+    numpy.lib.format.open_memmap) or use pulse_train_to_tx_chunks.
 
     Parameters
     ----------
@@ -70,6 +82,14 @@ def pulse_train_to_tx(pulse_train,num_periods=1,bits_per_period=4):
         The default is 1.
     bits_per_period : int, optional
         Wavelength of each sinusoidal period. The default is 4.
+    out : numpy.ndarray, optional
+        Contiguous complex array of length 
+        len(pulse_train)*num_periods*bits_per_period to write the waveform
+        into, e.g. complex64 or a memory map. The default is None, which 
+        returns a new complex128 array.
+    scale : float, optional
+        Factor applied to the waveform, e.g. 2**14 for the PlutoSDR. The 
+        default is 1.
 
     Returns
     -------
@@ -77,22 +97,75 @@ def pulse_train_to_tx(pulse_train,num_periods=1,bits_per_period=4):
         Waveform created from stretched pulse sequence.
 
     '''
-    pulse_stretch = stretch_pulse_train(pulse_train,
-                                        num_periods*bits_per_period)
+    pulse_train = np.asarray(pulse_train,dtype=float)
+    carrier = scale*_symbol_carrier(num_periods,bits_per_period)
     
-    N = len(pulse_stretch)
-    rx_freq = len(pulse_train)
+    if out is None:
+        out = np.empty(len(pulse_train)*len(carrier),dtype=complex)
+    elif out.shape != (len(pulse_train)*len(carrier),) or not out.flags.c_contiguous:
+        # reshape would silently write into a copy instead of out
+        raise ValueError('out must be a contiguous 1-D array of length '
+                         '{}'.format(len(pulse_train)*len(carrier)))
     
-    sin_factor = sinusoid(N,N,rx_freq*num_periods)
+    np.multiply(pulse_train[:,np.newaxis],carrier[np.newaxis,:],
+                out=out.reshape(len(pulse_train),len(carrier)),
+                casting='same_kind')
     
-    tx_pulse_train = pulse_stretch*sin_factor
+    return out
+
+def pulse_train_to_tx_chunks(pulse_train,num_periods=1,bits_per_period=4,
+                             chunk_size=2**16,scale=2**14,dtype=np.complex64):
+    '''
+    Generator version of pulse_train_to_tx for multi-million-symbol pulse 
+    trains. Yields the waveform in consecutive chunks of about chunk_size 
+    samples, each holding whole symbols, so that memory use does not depend
+    on the length of the pulse train. Concatenating the chunks gives
+    pulse_train_to_tx(pulse_train,num_periods,bits_per_period,scale=scale).
+
+    Parameters
+    ----------
+    pulse_train : array_like
+        Pulse sequence to be converted to SDR transmittable waveform.
+    num_periods : int, optional
+        Number of sinusoidal periods each pulse signal will be stretched to. 
+        The default is 1.
+    bits_per_period : int, optional
+        Wavelength of each sinusoidal period. The default is 4.
+    chunk_size : int, optional
+        Approximate number of samples per chunk. The default is 2**16.
+    scale : float, optional
+        Factor applied to the waveform. The default is 2**14, the PlutoSDR 
+        full-scale amplitude.
+    dtype : numpy.dtype, optional
+        Complex dtype of the chunks. The default is numpy.complex64.
+
+    Yields
+    ------
+    numpy.ndarray
+        Next chunk of the transmit waveform.
+
+    '''
+    pulse_train = np.asarray(pulse_train)
+    samples_per_symbol = num_periods*bits_per_period
+    symbols_per_chunk = max(1,int(chunk_size)//samples_per_symbol)
     
-    return tx_pulse_train
+    for start in range(0,len(pulse_train),symbols_per_chunk):
+        symbols = pulse_train[start:start+symbols_per_chunk]
+        out = np.empty(len(symbols)*samples_per_symbol,dtype=dtype)
+        yield pulse_train_to_tx(symbols,num_periods,bits_per_period,
+                                out=out,scale=scale)
 
 def rx_to_pulse_train(rx_samples,num_periods,bits_per_period):
     '''
     Takes a received SDR signal generated by pulse_train_to_tx and converts it
-    to a binary pulse train.
+    to a binary pulse train, with the matched filter, symbol timing recovery
+    and adaptive threshold of PulseTrainDemodulator.
+    
+    One pulse is returned per started symbol after the recovered symbol 
+    timing, so a capture of N whole symbols gives N pulses; a symbol cut 
+    off at the end of the capture is decided on the samples received. The
+    symbol timing is tracked through the capture, so sample clock drift 
+    between the radios is followed.
 
     Parameters
     ----------
@@ -110,25 +183,542 @@ def rx_to_pulse_train(rx_samples,num_periods,bits_per_period):
         Sequence of binary signals generated from pulse signal waveform.
 
     '''
-    rx_abs = np.abs(rx_samples)
-    bits_per_symbol = num_periods*bits_per_period
-    check_value = 0.5 * (max(rx_abs) + min(rx_abs))
+    demodulator = PulseTrainDemodulator(num_periods,bits_per_period)
+    return np.concatenate((demodulator.process(rx_samples),demodulator.flush()))
+
+def _sliding_extreme(values,window,ufunc):
+    '''
+    ufunc (np.maximum or np.minimum) over every window of window consecutive
+    values, in O(len(values)) whatever the window length: within blocks of
+    window values, a window is covered by a suffix of one block and a prefix
+    of the next (van Herk / Gil-Werman).
+    '''
+    n = len(values) - window + 1
+    blocks = -(-len(values)//window)
+    padded = np.concatenate((values,np.full(blocks*window-len(values),values[-1])))
+    padded = padded.reshape(blocks,window)
+    prefix = ufunc.accumulate(padded,axis=1).ravel()
+    suffix = ufunc.accumulate(padded[:,::-1],axis=1)[:,::-1].ravel()
+    return ufunc(suffix[:n],prefix[window-1:window-1+n])
+
+class PulseTrainDemodulator():
+    '''
+    Chunked matched-filter demodulator for pulse_train_to_tx waveforms, for
+    continuous receive or whole captures.
     
-    rx_pulse_train = (rx_abs[::bits_per_symbol] > check_value).astype(int)
+    Each chunk is processed with array operations:
+        - Matched filter: the samples are derotated by the carrier (counted 
+          from the start of the stream) and integrated over one symbol with
+          a running sum, giving the symbol energy amplitude for every 
+          possible symbol start. Its magnitude does not depend on the 
+          carrier phase, so delays and slow frequency offsets are tolerated.
+        - Timing recovery: the symbol start is the offset, modulo the 
+          symbol length, with the largest mean squared matched filter 
+          output. Misaligned starts straddle two symbols and have less 
+          energy. The estimate is updated every timing_block symbols, 
+          averaged with exponential forgetting over about timing_memory 
+          symbols, so it follows the drift between the transmit and 
+          receive sample clocks however large the chunks are. The offset 
+          only changes when another one has switch_ratio times its metric,
+          and then moves by the shorter way round.
+        - Half-symbol moves: with an even number of samples per symbol 
+          (always at 2), both ways round are equally short, and the 
+          energies cannot tell which way the clocks drifted. A move within
+          undo_window symbols of the previous one reverses it, taking it 
+          as noise around the midway point. Otherwise the move goes the way
+          the last timing_block symbols leak into their neighbours, taken 
+          from whether 1s next to a 0 are weaker before or after it. This
+          needs band-limited pulses, at least 16 symbols, and a difference 
+          of 3 standard errors; failing that, it repeats the last move. 
+          With ideal rectangular pulses at 2 samples per symbol the leak is
+          symmetric, so drift against the first move's direction is lost.
+        - Adaptive threshold: each symbol is compared to the midpoint of the
+          largest and smallest symbol amplitude in a sliding window of the
+          last threshold_window symbols, which follows gain drift. While the
+          window holds only one level (its smallest amplitude is above 
+          contrast times its largest), the last valid threshold is kept; 
+          symbols before the first window with both levels use that 
+          window's threshold.
     
-    return rx_pulse_train
+    Filter, timing and threshold state carry over chunk boundaries, so a 
+    stream can be cut into chunks of any size. This decodes down to 2 
+    samples per symbol (num_periods=1 with bits_per_period=2, or, clear of
+    the band edge, a baseband pulse with num_periods=2, bits_per_period=1).
+
+    Parameters
+    ----------
+    num_periods : int
+        Number of sinusoidal periods each pulse signal has been stretched to.
+    bits_per_period : int
+        Wavelength of each sinusoidal period.
+    threshold_window : int, optional
+        Number of symbols in the sliding threshold window. The default is 32.
+    contrast : float, optional
+        Smallest to largest amplitude ratio above which a window is taken to
+        hold a single level. The default is 0.5.
+    timing_block : int, optional
+        Number of symbols between timing updates. The default is 64.
+    timing_memory : float, optional
+        Number of symbols the timing estimate is averaged over. The default
+        is 64.
+    switch_ratio : float, optional
+        Factor by which the best start offset's metric must exceed the 
+        current one's before the timing moves. Larger values ride through 
+        more noise and low gain without moving, but follow clock drift 
+        later. The default is 1.2.
+    undo_window : int, optional
+        Number of symbols within which a half-symbol move reverses the 
+        previous one. It should be longer than noise holds the metric 
+        around a midway point, and shorter than the spacing of genuine 
+        moves, about 1e6/(ppm*num_periods*bits_per_period) symbols for a 
+        clock offset of ppm (5000 at 100 ppm and 2 samples per symbol). 
+        The default is 4096.
+
+    '''
+    def __init__(self,num_periods,bits_per_period,threshold_window=32,
+                 contrast=0.5,timing_block=64,timing_memory=64,
+                 switch_ratio=1.2,undo_window=4096):
+        self.bits_per_symbol = num_periods*bits_per_period
+        self.threshold_window = max(1,int(threshold_window))
+        self.contrast = contrast
+        self.timing_block = max(1,int(timing_block))
+        self.timing_memory = timing_memory
+        self.switch_ratio = switch_ratio
+        self.undo_window = undo_window
+        
+        n = np.arange(bits_per_period)
+        self._derotate = np.exp(-2.0j*np.pi*n/bits_per_period).astype(np.complex64)
+        self._position = 0 # stream index of the first sample of the next chunk
+        self._tail = np.zeros(0,dtype=np.complex64)
+        self._counted = 0 # stream index of the first window not in the timing metric
+        self._metric = [0.0]*self.bits_per_symbol
+        self.phase = None
+        self._next = None # stream index of the next symbol start
+        self._direction = 1 # direction of the last timing move
+        self._last_tie = None # stream index of the last half-symbol move
+        self._amplitudes = np.zeros(0)
+        self._threshold = np.nan
+        self._max = -np.inf
+        self._min = np.inf
 
-def check_fidelity(tx_pulse_train,rx_pulse_train):
+    def _symbol_starts(self,start,mf):
+        '''
+        Runs timing recovery over the windows of mf (the matched filter 
+        output for windows starting at stream index start) not yet counted,
+        one timing block at a time, and returns the indices into mf of the
+        symbols that start in them.
+        '''
+        S = self.bits_per_symbol
+        lo = self._counted - start
+        if lo >= len(mf):
+            return np.zeros(0,dtype=int)
+        
+        # mean squared output per block and start offset, for all blocks at once
+        B = S*self.timing_block
+        edges = np.arange(lo,len(mf),B)
+        ends = np.minimum(edges + B,len(mf))
+        k = np.arange(lo,len(mf))
+        bins = ((k - lo)//B)*S + (start + k) % S
+        power = np.bincount(bins,weights=mf[lo:]**2,minlength=len(edges)*S)
+        counts = np.bincount(bins,minlength=len(edges)*S)
+        means = (power/np.maximum(counts,1)).reshape(-1,S).tolist()
+        forgets = np.exp(-(ends - edges)/(S*self.timing_memory)).tolist()
+        self._counted = start + len(mf)
+        
+        # the forgetting average and offset decisions are sequential, but 
+        # only cost a few operations per block
+        metric = self._metric
+        phase = self.phase
+        nxt = self._next
+        firsts = []
+        numbers = []
+        for b in range(len(edges)):
+            f = forgets[b]
+            metric = [f*m + (1-f)*p for m,p in zip(metric,means[b])]
+            best = max(range(S),key=metric.__getitem__)
+            if phase is None:
+                phase = best
+                nxt = start + int(edges[b]) + (best - start - int(edges[b])) % S
+            elif best != phase and metric[best] > self.switch_ratio*metric[phase]:
+                shift = (best - nxt) % S
+                if 2*shift == S:
+                    # half a symbol either way: see the class docstring
+                    if self._last_tie is not None and nxt - self._last_tie < self.undo_window*S:
+                        direction = -self._direction
+                    else:
+                        recent = mf[max(0,nxt - start - B):nxt - start:S]
+                        direction = np.sign(self._lead(recent)) or self._direction
+                    if direction < 0:
+                        shift -= S
+                    self._last_tie = nxt
+                elif shift > S//2:
+                    shift -= S
+                self._direction = 1 if shift > 0 else -1
+                phase = best
+                nxt = max(nxt + shift,start)
+            
+            first = nxt - start
+            n = max(0,-(-(int(ends[b]) - first)//S))
+            firsts.append(first)
+            numbers.append(n)
+            nxt += n*S
+        
+        self._metric = metric
+        self.phase = phase
+        self._next = nxt
+        
+        numbers = np.array(numbers)
+        offsets = np.array(firsts) - S*(np.cumsum(numbers) - numbers)
+        return np.repeat(offsets,numbers) + S*np.arange(numbers.sum())
+
+    def _lead(self,amplitudes):
+        '''
+        Which neighbour leaks into the symbol windows, from the amplitudes of
+        recent symbols: returns > 0 when 1s after a 0 are weaker than 1s 
+        before a 0, i.e. the windows start early and overlap the previous 
+        symbol, < 0 for the opposite, and 0 if undecided (fewer than 16 
+        symbols, or a difference within 3 standard errors).
+        '''
+        if len(amplitudes) < 16:
+            return 0
+        d = amplitudes > 0.5*(amplitudes.max() + amplitudes.min())
+        after_0 = d[1:-1] & ~d[:-2]
+        before_0 = d[1:-1] & ~d[2:]
+        if after_0.sum() < 2 or before_0.sum() < 2:
+            return 0
+        a = amplitudes[1:-1]
+        lead = np.mean(a[before_0]) - np.mean(a[after_0])
+        # only trust differences well above the noise
+        error = np.sqrt(np.var(a[before_0])/before_0.sum() + 
+                        np.var(a[after_0])/after_0.sum())
+        return lead if abs(lead) > 3*error else 0
+
+    def _decide(self,amplitudes):
+        if len(amplitudes) == 0:
+            return np.zeros(0,dtype=int)
+        
+        W = self.threshold_window
+        self._max = max(self._max,amplitudes.max())
+        self._min = min(self._min,amplitudes.min())
+        
+        history = self._amplitudes
+        if len(history) < W-1:
+            first = history[0] if len(history) > 0 else amplitudes[0]
+            history = np.concatenate((np.full(W-1-len(history),first),history))
+        values = np.concatenate((history,amplitudes))
+        hi = _sliding_extreme(values,W,np.maximum)
+        lo = _sliding_extreme(values,W,np.minimum)
+        midpoint = 0.5*(hi + lo)
+        
+        # forward-fill the threshold of the last window that held both levels
+        valid = lo < self.contrast*hi
+        last_valid = np.maximum.accumulate(np.where(valid,np.arange(len(valid)),-1))
+        threshold = midpoint[np.maximum(last_valid,0)]
+        if not np.isnan(self._threshold):
+            threshold[last_valid < 0] = self._threshold
+        elif valid.any():
+            # no contrast seen before: back-fill from the first valid window
+            threshold[last_valid < 0] = midpoint[np.argmax(valid)]
+        else:
+            # no contrast seen at all: midpoint of everything received so far
+            threshold[:] = 0.5*(self._max + self._min)
+        if valid.any():
+            self._threshold = threshold[-1]
+        
+        self._amplitudes = values[-(W-1):] if W > 1 else values[:0]
+        return (amplitudes > threshold).astype(int)
+
+    def process(self,rx_samples):
+        '''
+        Converts the next chunk of received samples to binary pulses.
+
+        Parameters
+        ----------
+        rx_samples : array_like
+            Next chunk of received samples.
+
+        Returns
+        -------
+        rx_pulse_train : array_like
+            Pulses of the symbols that end in this chunk.
+
+        '''
+        S = self.bits_per_symbol
+        rx_samples = np.asarray(rx_samples,dtype=np.complex64)
+        x = np.concatenate((self._tail,rx_samples))
+        start = self._position - len(self._tail) # stream index of x[0]
+        self._position += len(rx_samples)
+        if len(x) < S:
+            self._tail = x
+            return np.zeros(0,dtype=int)
+        
+        # matched filter output for windows starting at start .. start+len(mf)-1
+        y = x*self._derotate[(start + np.arange(len(x))) % len(self._derotate)]
+        total = np.concatenate(([0],np.cumsum(y)))
+        mf = np.abs(total[S:] - total[:-S])
+        
+        amplitudes = mf[self._symbol_starts(start,mf)]
+        
+        # keep one symbol before the next start, so the timing can move back
+        self._tail = x[max(0,self._next - S - start):]
+        return self._decide(amplitudes)
+
+    def flush(self):
+        '''
+        Decides the last, incomplete symbol from the samples received of it,
+        e.g. at the end of a capture. The demodulator can be used again 
+        afterwards.
+
+        Returns
+        -------
+        rx_pulse_train : array_like
+            Pulse of the incomplete symbol, if any samples of it were 
+            received.
+
+        '''
+        S = self.bits_per_symbol
+        if self._next is None:
+            return np.zeros(0,dtype=int)
+        start = self._position - len(self._tail)
+        partial = self._tail[self._next - start:]
+        if len(partial) == 0:
+            return np.zeros(0,dtype=int)
+        
+        n = self._next + np.arange(len(partial))
+        amplitude = np.abs(np.sum(partial*self._derotate[n % len(self._derotate)]))*S/len(partial)
+        self._tail = self._tail[:0]
+        self._counted = self._position
+        self._next += S
+        return self._decide(np.array([amplitude]))
+
+class RxStream():
     '''
-    Checks each phase shift to find the shift at which the dot product of the
-    transmitted and received pulse trains is equal to the sum of one of the
-    pulse trains. This would imply that all the ones in the pulse train are
-    aligned and matching.
+    Continuous receive from one SDR. A producer thread calls rx() on the 
+    device back to back and copies each buffer into a preallocated ring of
+    num_buffers slots; read() hands the buffers to the consumer in order. 
+    Memory use is fixed by the ring size, however long the capture runs.
+    
+    When the consumer falls behind and the ring is full, the newest buffer
+    is dropped and counted in overruns. Buffers that fail to read or have
+    the wrong length are counted in dropped, which also includes overruns.
+    After a failed rx() the producer backs off, doubling the wait from 1 ms
+    on each consecutive failure; after max_errors consecutive failures 
+    (e.g. the radio was unplugged) it gives up, and read() raises the last
+    error once the buffers already received have been read. The last error
+    is also kept in error.
+
+    Parameters
+    ----------
+    rx_dev : adi.Pluto or SimulatedPluto
+        Receiving device, with rx_buffer_size already set to buffer_size. 
+        No one else may call its rx() while the stream runs.
+    buffer_size : int
+        Number of samples per receive buffer.
+    num_buffers : int, optional
+        Number of ring slots. The default is 64.
+    max_errors : int, optional
+        Number of consecutive failed rx() calls after which the stream 
+        gives up. The default is 10.
+
+    '''
+    def __init__(self,rx_dev,buffer_size,num_buffers=64,max_errors=10):
+        self.rx_dev = rx_dev
+        self.max_errors = max_errors
+        self.ring = np.empty((num_buffers,int(buffer_size)),dtype=np.complex64)
+        
+        self.received = 0
+        self.dropped = 0
+        self.overruns = 0
+        self.error = None
+        
+        self._failed = False
+        self._head = 0
+        self._count = 0
+        self._held = False
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''
+        Starts the producer thread.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self._stop.clear()
+        self._failed = False
+        self.error = None
+        self._thread = threading.Thread(target=self._produce,daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the producer thread after its current rx() call.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._cond:
+            self._cond.notify_all()
+
+    def _produce(self):
+        num_buffers,buffer_size = self.ring.shape
+        errors = 0
+        while not self._stop.is_set():
+            try:
+                data = self.rx_dev.rx()
+            except Exception as e:
+                self.dropped += 1
+                self.error = e
+                errors += 1
+                if errors >= self.max_errors:
+                    # give up; the consumer raises the error
+                    with self._cond:
+                        self._failed = True
+                        self._cond.notify_all()
+                    return
+                self._stop.wait(1e-3 * 2**(errors-1))
+                continue
+            errors = 0
+            
+            if len(data) != buffer_size:
+                self.dropped += 1
+                continue
+            
+            with self._cond:
+                # the slot being read by the consumer stays occupied
+                if self._count == num_buffers:
+                    self.overruns += 1
+                    self.dropped += 1
+                    continue
+                self.ring[self._head] = data
+                self._head = (self._head + 1) % num_buffers
+                self._count += 1
+                self.received += 1
+                self._cond.notify()
+
+    def read(self,timeout=None):
+        '''
+        Returns the next received buffer, waiting up to timeout seconds. The
+        returned array is a view of a ring slot and is only valid until the
+        next call to read.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for a buffer. The default is None, which waits 
+            until a buffer arrives or the stream is stopped.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            Next buffer of complex64 samples, or None if no buffer arrived 
+            in time or the stream was stopped.
+
+        Raises
+        ------
+        Exception
+            The last receive error, once the producer has given up after 
+            max_errors consecutive failed rx() calls and the buffers 
+            received before that have been read.
+
+        '''
+        num_buffers = len(self.ring)
+        with self._cond:
+            if self._held:
+                self._count -= 1
+                self._held = False
+            
+            if not self._cond.wait_for(lambda: self._count > 0 or self._failed
+                                       or self._stop.is_set(),timeout):
+                return None
+            if self._count == 0:
+                if self._failed:
+                    raise self.error
+                return None
+            
+            tail = (self._head - self._count) % num_buffers
+            self._held = True
+            return self.ring[tail]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+def stream_pulse_train(stream,num_periods,bits_per_period,num_buffers=None,
+                       timeout=1.0):
+    '''
+    Demodulates a running RxStream chunk by chunk, yielding the binary pulse
+    train of each received buffer.
+
+    Parameters
+    ----------
+    stream : RxStream
+        Started receive stream.
+    num_periods : int
+        Number of sinusoidal periods each pulse signal has been stretched to.
+    bits_per_period : int
+        Wavelength of each sinusoidal period.
+    num_buffers : int, optional
+        Number of buffers to demodulate. The default is None, which runs 
+        until the stream is stopped or no buffer arrives within timeout.
+        If the stream gives up after repeated receive errors, the last 
+        error is raised (see RxStream).
+    timeout : float, optional
+        Seconds to wait for each buffer. The default is 1.0.
+
+    Yields
+    ------
+    rx_pulse_train : array_like
+        Pulses of the next received buffer.
+
+    '''
+    demodulator = PulseTrainDemodulator(num_periods,bits_per_period)
+    n = 0
+    while num_buffers is None or n < num_buffers:
+        rx_samples = stream.read(timeout)
+        if rx_samples is None:
+            return
+        yield demodulator.process(rx_samples)
+        n += 1
+
+class FidelityResult(namedtuple('FidelityResult',
+                                 ['match','lag','bit_errors','bit_error_rate'])):
+    '''
+    Result of check_fidelity. Evaluates as True when the pulse trains match,
+    so it can be used where check_fidelity used to return a bool.
+    '''
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.match)
+
+def check_fidelity(tx_pulse_train,rx_pulse_train,verbose=True):
+    '''
+    Finds the circular shift of the received pulse train that best matches
+    the transmitted one and counts the bit errors at that shift.
+    
+    For binary trains t and r, the number of bit errors at lag k is
+    sum(t) + sum(r) - 2*c[k], where c[k] = sum_i t[i]*r[(i+k) % N] is the
+    circular cross-correlation. All N correlations are computed at once 
+    with FFTs in O(N log N), and the best lag is the one with the fewest 
+    errors. Pulse trains with different numbers of 1s are compared the same
+    way; they simply cannot match.
     
     Assumptions:
         - Both pulse trains must be binary (1s and 0s only).
-        - This check only works if the pulse trains have the same number of 1s
-          and 0s as each other. This is verified before entering the for loop.
 
     Parameters
     ----------
@@ -136,37 +726,603 @@ def check_fidelity(tx_pulse_train,rx_pulse_train):
         Transmitted binary pulse sequence.
     rx_pulse_train : array_like
         Received binary pulse sequence.
+    verbose : bool, optional
+        Print the lag and bit errors of a match. The default is True.
 
     Returns
     -------
-    bool
-        Check as to whether the binary pulse sequences match (with or without a
-        phase shift).
+    FidelityResult
+        Named tuple (match, lag, bit_errors, bit_error_rate): whether the 
+        binary pulse sequences match (with or without a phase shift), the 
+        shift of the received sequence at which they match best, and the
+        number and fraction of bits that differ at that shift. Evaluates as
+        match in a boolean context.
     '''    
-    t_len = len(tx_pulse_train)
-    r_len = len(rx_pulse_train)
-    t_sum = sum(tx_pulse_train)
-    r_sum = sum(rx_pulse_train)
+    tx = np.asarray(tx_pulse_train,dtype=float)
+    rx = np.asarray(rx_pulse_train,dtype=float)
     
-    if t_len != r_len:
+    if len(tx) != len(rx):
         print('Error: Pulse train lengths do not match.')
-        return False
+        return FidelityResult(False,None,None,None)
+    
+    if len(tx) == 0:
+        return FidelityResult(True,0,0,0.0)
+    
+    corr = np.fft.irfft(np.conj(np.fft.rfft(tx))*np.fft.rfft(rx),n=len(tx))
+    lag = int(np.argmax(corr))
+    
+    bit_errors = int(round(tx.sum() + rx.sum() - 2*corr[lag]))
+    result = FidelityResult(bit_errors == 0,lag,bit_errors,bit_errors/len(tx))
+    
+    if verbose and result.match:
+        print('Out of phase by',lag)
+    
+    return result
+
+def welch_psd(rx_samples,sample_rate,segment_size=1024,overlap=0.5,
+              block_segments=64):
+    '''
+    Estimates the power spectral density of complex samples by averaging 
+    the periodograms of Hann-windowed, overlapping segments (Welch's 
+    method). Every FFT has the same power-of-two length however long the
+    capture is, and segments are transformed block_segments at a time, so
+    the cost grows linearly with the capture and memory stays bounded.
+
+    Parameters
+    ----------
+    rx_samples : array_like
+        Complex samples.
+    sample_rate : float
+        Sampling frequency of the samples.
+    segment_size : int, optional
+        Length of each segment, rounded down to a power of two and to at 
+        most the length of the capture. The default is 1024.
+    overlap : float, optional
+        Fraction of each segment shared with the next one. The default is 
+        0.5.
+    block_segments : int, optional
+        Number of segments transformed per FFT call. The default is 64.
+
+    Returns
+    -------
+    f : np.ndarray
+        Frequencies from -sample_rate/2 to sample_rate/2, in Hz.
+    psd : np.ndarray
+        Power spectral density at f, in power per Hz.
+
+    '''
+    rx_samples = np.asarray(rx_samples)
+    n = min(int(segment_size),len(rx_samples))
+    if n < 1:
+        return np.zeros(0),np.zeros(0)
+    n = 1 << (n.bit_length()-1)
+    step = max(1,int(n*(1-overlap)))
+    
+    window = np.hanning(n+1)[:-1] # periodic Hann, as scipy.signal.welch
+    segments = np.lib.stride_tricks.sliding_window_view(rx_samples,n)[::step]
+    power = np.zeros(n)
+    for i in range(0,len(segments),block_segments):
+        spectra = np.fft.fft(segments[i:i+block_segments]*window,axis=1)
+        power += np.sum(spectra.real**2 + spectra.imag**2,axis=0)
     
-    if t_sum != r_sum:
-        return False
+    psd = np.fft.fftshift(power)/(len(segments)*sample_rate*np.sum(window**2))
+    f = np.fft.fftshift(np.fft.fftfreq(n,1/sample_rate))
+    return f,psd
+
+class DiagnosticsPlotter():
+    '''
+    Background consumer for receive diagnostics. submit() only queues the
+    received samples and returns, so a capture loop is never held up by 
+    diagnostics; a worker thread then computes the requested traces (the 
+    averaged spectrum only when plot_fft is set). Matplotlib is not thread
+    safe, so the traces are drawn by show(), which must be called from the
+    main thread, e.g. between or after captures, and close() stops the 
+    worker. When the worker falls 
+    more than max_pending captures behind, new captures are skipped and 
+    counted in dropped rather than waited for.
+
+    Parameters
+    ----------
+    sample_rate : float
+        Sampling frequency of the received samples.
+    segment_size : int, optional
+        Segment length of the averaged spectrum (see welch_psd). The 
+        default is 1024.
+    max_pending : int, optional
+        Number of captures that can wait for the worker. The default is 4.
+
+    '''
+    def __init__(self,sample_rate,segment_size=1024,max_pending=4):
+        self.sample_rate = sample_rate
+        self.segment_size = segment_size
+        self.dropped = 0
+        
+        self._jobs = queue.Queue(max_pending)
+        self._traces = []
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._consume,daemon=True)
+        self._worker.start()
+
+    def submit(self,rx_samples=None,rx_pulse_train=None,plot_rx_samples=True,
+               plot_rx_pulse_train=True,plot_fft=True):
+        '''
+        Queues the diagnostics of one capture without waiting for them.
+        
+        Returns
+        -------
+        bool
+            Whether the capture was queued (False if the worker is behind).
+        '''
+        job = (rx_samples if plot_rx_samples or plot_fft else None,
+               rx_pulse_train if plot_rx_pulse_train else None,
+               plot_rx_samples,plot_fft)
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _consume(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            rx_samples,rx_pulse_train,plot_rx_samples,plot_fft = job
+            try:
+                traces = []
+                # Received samples in time domain. Swap np.abs for np.real or
+                # np.imag to see the components
+                if plot_rx_samples:
+                    traces.append((None,np.abs(rx_samples),"Time",None))
+                if rx_pulse_train is not None:
+                    traces.append((None,np.asarray(rx_pulse_train),"Pulse Index",None))
+                if plot_fft:
+                    f,psd = welch_psd(rx_samples,self.sample_rate,self.segment_size)
+                    traces.append((f/1e6,10*np.log10(psd),"Frequency [MHz]","PSD [dB/Hz]"))
+                with self._lock:
+                    self._traces.extend(traces)
+            finally:
+                self._jobs.task_done()
+
+    def show(self,block=True):
+        '''
+        Waits for the queued captures and draws their traces, one figure 
+        each. Call from the main thread.
+
+        Parameters
+        ----------
+        block : bool, optional
+            Passed to plt.show. The default is True.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self._jobs.join()
+        with self._lock:
+            traces,self._traces = self._traces,[]
+        if len(traces) == 0:
+            return
+        
+        for x,y,xlabel,ylabel in traces:
+            plt.figure()
+            if x is None:
+                plt.plot(y)
+            else:
+                plt.plot(x,y)
+            plt.xlabel(xlabel)
+            if ylabel is not None:
+                plt.ylabel(ylabel)
+        plt.show(block=block)
+
+    def close(self):
+        '''
+        Stops the worker thread once the queued captures are processed. 
+        Traces already computed can still be drawn with show().
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self._worker.is_alive():
+            self._jobs.put(None)
+            self._worker.join()
+
+# Radio backends. A backend is a callable that takes an SDR address and 
+# returns a device with the adi.Pluto attributes and tx/tx_destroy_buffer/rx
+# methods used in this module.
+
+def pluto_backend(uri):
+    '''
+    Opens a physical PlutoSDR at uri with pyadi-iio, which is only imported
+    when a physical radio is used.
+    '''
+    import adi
+    return adi.Pluto(uri)
+
+class SimulatedPluto():
+    '''
+    In-process stand-in for adi.Pluto. Configuration attributes are plain 
+    attributes; tx() starts cyclic transmission of a waveform into the 
+    shared SimulatedRadios channel, and rx() returns the next buffer of 
+    everything being transmitted, after the channel model. As on a Pluto, 
+    the receive buffer is created with rx_buffer_size samples on the first
+    rx() and keeps that size until rx_destroy_buffer() is called.
+    '''
+    def __init__(self,uri,radios):
+        self.uri = uri
+        self.radios = radios
+        self.sample_rate = 1000000
+        self.tx_rf_bandwidth = self.rx_rf_bandwidth = 1000000
+        self.tx_lo = self.rx_lo = 915000000
+        self.tx_hardwaregain_chan0 = -50
+        self.rx_hardwaregain_chan0 = 70.0
+        self.gain_control_mode_chan0 = 'manual'
+        self.tx_cyclic_buffer = True
+        self.rx_buffer_size = 1024
+        self._rx_buffer_len = None
+        self._position = 0
+
+    def tx(self,samples):
+        self.radios._transmit(self,np.asarray(samples,dtype=np.complex64))
+
+    def tx_destroy_buffer(self):
+        self.radios._transmit(self,None)
+
+    def rx(self):
+        if self._rx_buffer_len is None:
+            self._rx_buffer_len = int(self.rx_buffer_size)
+        return self.radios._receive(self,self._rx_buffer_len)
+
+    def rx_destroy_buffer(self):
+        self._rx_buffer_len = None
+
+class SimulatedRadios():
+    '''
+    Simulated radio backend: every SDR opened through it shares one channel,
+    so any radio receives the waveforms transmitted by all of them. Between
+    the transmit and receive sides the channel applies, in order, a delay 
+    and sample clock offset, a gain, a frequency offset, additive complex 
+    Gaussian noise and randomly dropped buffers.
     
-    for i in np.linspace(r_len,0,1+r_len).astype(int):#int(r_len/2),r_len):
-        r_temp = np.append(rx_pulse_train[i:],rx_pulse_train[:i])
-        if np.dot(r_temp,tx_pulse_train) == t_sum:
-            print('Out of phase by',i)
-            return True
+    With a clock offset or a fractional delay, the receiver samples the 
+    transmitted waveforms between their samples, by band-limited (windowed
+    sinc) interpolation. As through real converters, content near 
+    +-sample_rate/2 then fades at half-sample offsets; a bits_per_period=2 
+    carrier sits exactly there.
+
+    Parameters
+    ----------
+    gain : float, optional
+        Amplitude gain of the channel. The default is 1.
+    noise : float, optional
+        Standard deviation of the noise in each of I and Q, in the units of
+        the transmitted samples. The default is 0.
+    freq_offset : float, optional
+        Carrier frequency offset between the radios in Hz, applied at the 
+        receiver's sample_rate. The default is 0.
+    delay : float, optional
+        Delay in samples between the transmitter and the receivers. The 
+        default is 0.
+    clock_offset : float, optional
+        Receiver sample clock error relative to the transmitter, in parts 
+        per million: receive sample k is taken at transmit sample 
+        k*(1 + clock_offset*1e-6) - delay. The default is 0.
+    drop_rate : float, optional
+        Probability that a receive buffer is lost, so that the following 
+        buffer starts one buffer later. The default is 0.
+    realtime : bool, optional
+        Make rx() take as long as a real buffer takes to arrive at 
+        sample_rate. The default is False, which returns immediately.
+    seed : int, optional
+        Seed of the noise and drop random generator. The default is None.
+
+    '''
+    def __init__(self,gain=1.0,noise=0.0,freq_offset=0.0,delay=0,
+                 drop_rate=0.0,realtime=False,seed=None,clock_offset=0.0):
+        self.gain = gain
+        self.noise = noise
+        self.freq_offset = freq_offset
+        self.delay = delay
+        self.clock_offset = clock_offset
+        self.drop_rate = drop_rate
+        self.realtime = realtime
+        
+        self.devices = {}
+        self._waveforms = {}
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self,uri):
+        if uri not in self.devices:
+            self.devices[uri] = SimulatedPluto(uri,self)
+        return self.devices[uri]
+
+    def _transmit(self,dev,samples):
+        with self._lock:
+            if samples is None:
+                self._waveforms.pop(dev.uri,None)
+            else:
+                self._waveforms[dev.uri] = samples
+
+    def _receive(self,dev,n):
+        if self.realtime:
+            time.sleep(n/dev.sample_rate)
+        
+        with self._lock:
+            waveforms = list(self._waveforms.values())
+            if self.drop_rate > 0 and self._rng.random() < self.drop_rate:
+                dev._position += n
+            start = dev._position
+            dev._position += n
+            noise = None
+            if self.noise > 0:
+                noise = self._rng.standard_normal((2,n),dtype=np.float32)
+        
+        # cyclic transmit buffers: sample k of the air is sample k % len of
+        # each waveform, and the receiver sees sample (k - delay)
+        rx_samples = np.zeros(n,dtype=np.complex64)
+        if self.clock_offset == 0 and self.delay == int(self.delay):
+            k = np.arange(start,start+n) - int(self.delay)
+            for waveform in waveforms:
+                rx_samples += waveform[k % len(waveform)]
+        elif len(waveforms) > 0:
+            # 16-tap Blackman-windowed sinc between transmit samples
+            t = np.arange(start,start+n)*(1 + self.clock_offset*1e-6) - self.delay
+            k = np.floor(t).astype(np.int64)
+            taps = np.arange(-7,9)
+            d = (t - k)[:,np.newaxis] - taps
+            h = np.sinc(d)*(0.42 + 0.5*np.cos(np.pi*d/8) + 0.08*np.cos(2*np.pi*d/8))
+            for waveform in waveforms:
+                rx_samples += np.sum(waveform[(k[:,np.newaxis] + taps) % len(waveform)]*h,axis=1)
+        
+        if self.gain != 1:
+            rx_samples *= self.gain
+        if self.freq_offset != 0:
+            rx_samples *= np.exp(2.0j*np.pi*self.freq_offset*np.arange(start,start+n)/dev.sample_rate).astype(np.complex64)
+        if noise is not None:
+            rx_samples.real += self.noise*noise[0]
+            rx_samples.imag += self.noise*noise[1]
+        
+        return rx_samples
+
+class SDRLink():
+    '''
+    Long-lived transmit/receive session between two SDRs. The link opens 
+    both device handles once (a single handle when transmitting to itself),
+    remembers every attribute it has applied and only writes attributes 
+    whose value changed, so repeated transmissions do not pay the per-call
+    device setup of sdr_tx_rx. Receive buffers are only flushed after the 
+    transmitted waveform or the receive buffer size changed.
     
-    return False
+    Can be used as a context manager, which closes the link on exit.
+
+    Parameters
+    ----------
+    tx_sdr : str
+        IP address of transmitting SDR.
+    rx_sdr : str
+        IP address of receiving SDR. Can be the same as tx_sdr, as long as 
+        that SDR is connected to itself.
+    sample_rate : int
+        Sampling frequency of the signal.
+    center_freq : int
+        Transmission frequency of SDR.
+    tx_gain : float, optional
+        Transmit hardware gain in dB, valid range is -90 to 0 dB. The 
+        default is -50.
+    rx_gain : float, optional
+        Receive hardware gain in dB. The default is 70.0.
+    flush_buffers : int, optional
+        Number of receive buffers discarded before the first receive after
+        a change. The default is 10.
+    backend : callable, optional
+        Radio backend, called with an SDR address to open that SDR. The 
+        default is None, which opens physical PlutoSDRs with pyadi-iio. Pass
+        a SimulatedRadios instance to run without hardware.
+
+    '''
+    def __init__(self,tx_sdr,rx_sdr,sample_rate,center_freq,
+                 tx_gain=-50,rx_gain=70.0,flush_buffers=10,backend=None):
+        if backend is None:
+            backend = pluto_backend
+        self.tx_dev = backend(tx_sdr)
+        self.rx_dev = self.tx_dev if rx_sdr == tx_sdr else backend(rx_sdr)
+        self.flush_buffers = flush_buffers
+        
+        self._applied = {}
+        self._tx_samples = None
+        self._transmitting = False
+        self._needs_flush = True
+        
+        self.configure(sample_rate,center_freq,tx_gain,rx_gain)
+
+    def _devices(self):
+        if self.rx_dev is self.tx_dev:
+            return [self.tx_dev]
+        return [self.tx_dev,self.rx_dev]
+
+    def _set(self,dev,attr,value):
+        '''
+        Writes attr of dev only if it differs from the value last applied.
+        Returns True if the attribute was written.
+        '''
+        key = (id(dev),attr)
+        if key in self._applied and self._applied[key] == value:
+            return False
+        setattr(dev,attr,value)
+        self._applied[key] = value
+        return True
+
+    def _set_rx_buffer_size(self,num_samps):
+        '''
+        pyadi-iio creates the receive buffer on the first rx() and ignores
+        later size changes until it is destroyed, so a new size also 
+        destroys the current buffer.
+        '''
+        if self._set(self.rx_dev,'rx_buffer_size',int(num_samps)):
+            self.rx_dev.rx_destroy_buffer()
+            self._needs_flush = True
+
+    def configure(self,sample_rate=None,center_freq=None,
+                  tx_gain=None,rx_gain=None):
+        '''
+        Applies the given settings to both SDRs, skipping any that are 
+        already applied. Arguments left as None are not changed.
+
+        Parameters
+        ----------
+        sample_rate : int, optional
+            Sampling frequency of the signal, also used as the transmit and
+            receive filter cutoff.
+        center_freq : int, optional
+            Transmission frequency of SDR.
+        tx_gain : float, optional
+            Transmit hardware gain in dB.
+        rx_gain : float, optional
+            Receive hardware gain in dB.
+
+        Returns
+        -------
+        None.
+
+        '''
+        changed = False
+        for dev in self._devices():
+            if sample_rate is not None:
+                changed |= self._set(dev,'sample_rate',int(sample_rate))
+                changed |= self._set(dev,'tx_rf_bandwidth',int(sample_rate))
+                changed |= self._set(dev,'rx_rf_bandwidth',int(sample_rate))
+            if center_freq is not None:
+                changed |= self._set(dev,'tx_lo',int(center_freq))
+                changed |= self._set(dev,'rx_lo',int(center_freq))
+            if tx_gain is not None:
+                changed |= self._set(dev,'tx_hardwaregain_chan0',tx_gain)
+            if rx_gain is not None:
+                changed |= self._set(dev,'gain_control_mode_chan0','manual')
+                changed |= self._set(dev,'rx_hardwaregain_chan0',rx_gain)
+        
+        if changed:
+            self._needs_flush = True
+        if sample_rate is not None:
+            self.sample_rate = int(sample_rate)
+
+    def transmit(self,samples):
+        '''
+        Starts cyclic transmission of samples, replacing any waveform that is
+        already being transmitted. Nothing is done if samples is the waveform
+        already being transmitted.
+
+        Parameters
+        ----------
+        samples : array_like
+            Complex waveform scaled for the PlutoSDR (-2**14 to 2**14).
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self._transmitting:
+            if np.array_equal(samples,self._tx_samples):
+                return
+            self.tx_dev.tx_destroy_buffer()
+        self._set(self.tx_dev,'tx_cyclic_buffer',True)
+        self.tx_dev.tx(samples)
+        self._tx_samples = np.array(samples)
+        self._transmitting = True
+        self._needs_flush = True
+
+    def receive(self,num_samps):
+        '''
+        Receives one buffer of num_samps samples. Stale buffers are discarded
+        first if the waveform or configuration changed since the last call.
+
+        Parameters
+        ----------
+        num_samps : int
+            Number of samples to receive.
+
+        Returns
+        -------
+        rx_samples : array_like
+            Received complex samples.
+
+        '''
+        self._set_rx_buffer_size(num_samps)
+        
+        if self._needs_flush:
+            for ii in range(self.flush_buffers):
+                self.rx_dev.rx()
+            self._needs_flush = False
+        
+        return self.rx_dev.rx()
+
+    def stream(self,buffer_size,num_buffers=64):
+        '''
+        Creates a continuous receive stream on the receiving SDR. Start it 
+        (or use it as a context manager) before reading; do not call receive
+        while it runs.
+
+        Parameters
+        ----------
+        buffer_size : int
+            Number of samples per receive buffer.
+        num_buffers : int, optional
+            Number of ring buffer slots. The default is 64.
+
+        Returns
+        -------
+        RxStream
+            Receive stream on the receiving SDR.
+
+        '''
+        self._set_rx_buffer_size(buffer_size)
+        self._needs_flush = True
+        return RxStream(self.rx_dev,buffer_size,num_buffers)
+
+    def stop(self):
+        '''
+        Stops transmitting.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self._transmitting:
+            self.tx_dev.tx_destroy_buffer()
+            self._tx_samples = None
+            self._transmitting = False
+
+    def close(self):
+        '''
+        Stops transmitting and releases the device handles.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.stop()
+        self.tx_dev = None
+        self.rx_dev = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
 
 def sdr_tx_rx(sample_rate,center_freq,
               tx_sdr,rx_sdr,
               tx_data,tx_length,
-              plot_rx_pulse_train = True,plot_rx_samples = True,plot_fft = True,check_fid = True):
+              plot_rx_pulse_train = True,plot_rx_samples = True,plot_fft = True,check_fid = True,
+              link = None,backend = None,plotter = None,bits_per_period = 3):
     '''
     Transmit and receive a binary pulse sequence through SDR(s) to verify 
     signal fidelity.
@@ -199,6 +1355,22 @@ def sdr_tx_rx(sample_rate,center_freq,
     check_fid : bool, optional
         Specify whether you want to compare the transmitted and received pulse 
         sequences for transmission fidelity. The default is True.
+    link : SDRLink, optional
+        Open link to transmit and receive through, for repeated runs. The 
+        link keeps transmitting after the call; stop or close it when done.
+        The default is None, which opens a link to tx_sdr and rx_sdr for 
+        this call only.
+    backend : callable, optional
+        Radio backend used to open tx_sdr and rx_sdr when no link is given,
+        e.g. SimulatedRadios. The default is None, which uses physical 
+        PlutoSDRs.
+    plotter : DiagnosticsPlotter, optional
+        Background plotter that the requested plots are queued to, for 
+        repeated runs; call its show() to draw them. The default is None,
+        which draws the plots of this call before returning.
+    bits_per_period : int, optional
+        Samples per carrier period of each transmitted pulse. The default 
+        is 3.
 
     Returns
     -------
@@ -208,82 +1380,44 @@ def sdr_tx_rx(sample_rate,center_freq,
     
     tx_pulse_train = tx_data[:tx_length] #change this line to input/truncate pulse train
     num_periods = 1
-    bits_per_period = 3
     num_samps = len(tx_pulse_train)*num_periods*bits_per_period # number of samples per call to rx()
 
-    sdr1 = adi.Pluto(tx_sdr)
-    sdr2 = adi.Pluto(rx_sdr)
-    sdr1.sample_rate = int(sample_rate)
-    sdr1.sample_rate = int(sample_rate)
-
-    # Config Tx
-    sdr1.tx_rf_bandwidth = int(sample_rate) # filter cutoff, just set it to the same as sample rate
-    sdr1.tx_lo = int(center_freq)
-    sdr1.tx_hardwaregain_chan0 = -50 # Increase to increase tx power, valid range is -90 to 0 dB
-
-    sdr2.tx_rf_bandwidth = int(sample_rate) # filter cutoff, just set it to the same as sample rate
-    sdr2.tx_lo = int(center_freq)
-    sdr2.tx_hardwaregain_chan0 = -50 # Increase to increase tx power, valid range is -90 to 0 dB
-
-    # Config Rx
-    sdr1.rx_lo = int(center_freq)
-    sdr1.rx_rf_bandwidth = int(sample_rate)
-    sdr1.rx_buffer_size = num_samps
-    sdr1.gain_control_mode_chan0 = 'manual'
-    sdr1.rx_hardwaregain_chan0 = 70.0 # dB, increase to increase the receive gain, but be careful not to saturate the ADC
-
-    sdr2.rx_lo = int(center_freq)
-    sdr2.rx_rf_bandwidth = int(sample_rate)
-    sdr2.rx_buffer_size = num_samps
-    sdr2.gain_control_mode_chan0 = 'manual'
-    sdr2.rx_hardwaregain_chan0 = 70.0 # dB, increase to increase the receive gain, but be careful not to saturate the ADC
+    # Open a link for this call only, unless a persistent one was given
+    own_link = link is None
+    if own_link:
+        link = SDRLink(tx_sdr,rx_sdr,sample_rate,center_freq,backend=backend)
+    else:
+        link.configure(sample_rate,center_freq)
 
     # Create transmit waveform (defined by function in pulse train module)
-    samples = pulse_train_to_tx(tx_pulse_train,num_periods,bits_per_period)
-    samples *= 2**14 # The PlutoSDR expects samples to be between -2^14 and +2^14, not -1 and +1 like some SDRs
-
-    # Start the transmitter
-    sdr1.tx_cyclic_buffer = True # Enable cyclic buffers
-    sdr1.tx(samples) # start transmitting
-
-    # Clear buffer just to be safe
-    for ii in range(10):
-        raw_data = sdr2.rx()
+    # The PlutoSDR expects samples to be between -2^14 and +2^14, not -1 and +1 like some SDRs
+    samples = pulse_train_to_tx(tx_pulse_train,num_periods,bits_per_period,
+                                out=np.empty(num_samps,dtype=np.complex64),
+                                scale=2**14)
 
-    # Receive samples
-    rx_samples = sdr2.rx()
+    try:
+        # Start the transmitter and receive samples. A persistent link keeps
+        # transmitting until it is stopped, so the next call with the same 
+        # waveform needs no new transmit buffer or flush.
+        link.transmit(samples)
+        rx_samples = link.receive(num_samps)
+    finally:
+        # Stop transmitting
+        if own_link:
+            link.close()
 
-    # Stop transmitting
-    sdr1.tx_destroy_buffer()
-
-    # Calculate power spectral density (frequency domain version of signal)
-    psd = np.abs(np.fft.fftshift(np.fft.fft(rx_samples)))**2
-    psd_dB = 10*np.log10(psd)
-    f = np.linspace(sample_rate/-2, sample_rate/2, len(psd))
-
-    # Plot received samples in time domain. Toggle commenting out real, imag, abs
-    if plot_rx_samples:
-        plt.figure()
-        #plt.plot(np.real(rx_samples))#[:1000]))
-        #plt.plot(np.imag(rx_samples))#[:1000]))
-        plt.plot(np.abs(rx_samples))#[:1000]))
-        plt.xlabel("Time")
-
-    # Plot processed received pulse train
+    # Process received pulse train
     rx_pulse_train = rx_to_pulse_train(rx_samples,num_periods,bits_per_period)
 
-    if plot_rx_pulse_train:
-        plt.figure()
-        plt.plot(rx_pulse_train)#[:2500]))
-        plt.xlabel("Pulse Index")
-
-    #Plot freq domain
-    if plot_fft:
-        plt.figure()
-        plt.plot(f/1e6, psd_dB)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel("PSD")
-        plt.show()
+    # Diagnostics are only computed when a plot is requested, on the
+    # plotter's worker thread
+    own_plotter = False
+    if plot_rx_samples or plot_rx_pulse_train or plot_fft:
+        own_plotter = plotter is None
+        if own_plotter:
+            plotter = DiagnosticsPlotter(sample_rate)
+        plotter.submit(rx_samples,rx_pulse_train,
+                       plot_rx_samples,plot_rx_pulse_train,plot_fft)
 
     # Verify fidelity of pulse train transmission
     if check_fid:
@@ -292,3 +1426,13 @@ def sdr_tx_rx(sample_rate,center_freq,
             print('Success! Perfect Transmission!')
         else:
             print('Uh oh. Something was lost in translation.')
+            if fidelity_check.lag is not None:
+                print(fidelity_check.bit_errors,'bit errors (BER',
+                      fidelity_check.bit_error_rate,') at best shift',
+                      fidelity_check.lag)
+
+    # A plotter of this call only is drawn now; a given plotter is drawn
+    # by its owner with plotter.show()
+    if own_plotter:
+        plotter.show()
+        plotter.close()